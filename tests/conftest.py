@@ -1,5 +1,6 @@
 import pickle
 
+from addict import Dict
 from pathlib import Path
 from pytest import fixture
 from string import Template
@@ -60,8 +61,8 @@ def extraneousDirs():
 
 
 @fixture
-def valiantOpts(scope="session"):
-    return Opts("valiant")
+def valiantOpts(tmp_path_factory, scope="session"):
+    return Opts("valiant", cache=tmp_path_factory.mktemp("cache"))
 
 
 @fixture
@@ -89,3 +90,65 @@ def templates(resources):
         for t in (resources / "directory_templates").iterdir()
         if not t.is_dir()
     }
+
+
+# NOTE: Stands in for `valiant.sh.SH', recording every command run through it;
+#       `outputs' maps commands such as "nix.eval" or "cue" to what they print,
+#       to an exception they raise, or to a function of their arguments,
+#       and anything else prints `default', or fails when there isn't one.
+class FakeSH:
+    def __init__(self, outputs=None, default=None):
+        self.outputs = outputs or dict()
+        self.default = default
+        self.calls = []
+
+    def __getattr__(self, attr):
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        return FakeCommand(self, attr)
+
+    def called(self, name):
+        return [call for call in self.calls if call.name == name]
+
+    @property
+    def exprs(self):
+        return [call.kwargs.expr for call in self.called("nix.eval")]
+
+    def run(self, name, args, kwargs):
+        self.calls.append(Dict(name=name, args=args, kwargs=kwargs))
+        parts = name.split(".")
+        for prefix in (".".join(parts[:i]) for i in range(len(parts), 0, -1)):
+            if prefix in self.outputs:
+                output = self.outputs[prefix]
+                break
+        else:
+            if self.default is None:
+                raise AssertionError(f"{name} was run")
+            output = self.default
+        if isinstance(output, Exception):
+            raise output
+        return output(*args, **kwargs) if callable(output) else output
+
+
+class FakeCommand:
+    def __init__(self, sh, name, args=tuple(), kwargs=None):
+        self.sh = sh
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs or dict()
+
+    def __getattr__(self, attr):
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        return FakeCommand(self.sh, f"{self.name}.{attr}", self.args, self.kwargs)
+
+    def bake(self, *args, **kwargs):
+        return FakeCommand(self.sh, self.name, self.args + args, self.kwargs | kwargs)
+
+    def __call__(self, *args, **kwargs):
+        return self.sh.run(self.name, self.args + args, self.kwargs | kwargs)
+
+
+@fixture
+def fakeSH():
+    return FakeSH
@@ -3,7 +3,11 @@ from parametrized import parametrized
 from pathlib import Path
 from pytest import mark, param, fixture
 from rich.pretty import pprint
-from valiant import Opts, building
+from shutil import copy, which
+from threading import Barrier, Event
+from time import perf_counter
+from valiant import Opts, Workspace, building
+from valiant.miscellaneous import nixEvaluation, nixEvaluations
 
 
 @mark.opts
@@ -62,3 +66,217 @@ class TestOpts:
         dirs = valiantOpts(directory=resources, all_formats=True).dirs
         assert all((d == "./." or Path(d).exists()) for d in dirs)
         assert len(dirs) == sumOfDirs
+
+
+@mark.opts
+class TestCache:
+    @fixture
+    def cue(self, tmp_path):
+        file = tmp_path / "valiant.cue"
+        file.write_text('dirs: ["./."]\n')
+        return file
+
+    @fixture
+    def sh(self, fakeSH):
+        return fakeSH({"cue.export": '{"dirs": ["./."]}'})
+
+    def test_cached(self, cue, sh, tmp_path):
+        opts = Opts(name="valiant", sh=sh, cache=tmp_path / "cache")
+        for _ in range(2):
+            assert opts(directory=tmp_path, format="cue") == dict(dirs=["./."])
+        assert len(sh.called("cue.export")) == 1
+        assert Opts(name="valiant", sh=sh, cache=tmp_path / "cache")(file=cue) == dict(
+            dirs=["./."]
+        )
+        assert len(sh.called("cue.export")) == 1
+
+    def test_changed(self, cue, sh, tmp_path):
+        opts = Opts(name="valiant", sh=sh, cache=tmp_path / "cache")
+        opts(file=cue)
+        cue.write_text('dirs: ["./.", "./."]\n')
+        opts(file=cue)
+        assert len(sh.called("cue.export")) == 2
+
+    def test_refresh(self, cue, sh, tmp_path):
+        opts = Opts(name="valiant", sh=sh, cache=tmp_path / "cache", refresh=True)
+        opts(file=cue)
+        opts(file=cue)
+        assert len(sh.called("cue.export")) == 2
+
+
+@mark.opts
+class TestDiscovery:
+    def test_present(self, tmp_path, valiantOpts):
+        for name in ("valiant.json", "vflake.nix", "valiant.bzl", "other.toml"):
+            (tmp_path / name).write_text("{}")
+        (tmp_path / "valiant.toml").mkdir()
+        assert valiantOpts._present(tmp_path) == {"json", "flake", "bazel"}
+        assert valiantOpts._present(tmp_path / "missing") == set()
+
+    def test_methods(self, valiantOpts):
+        assert valiantOpts._methods is Opts("other")._methods
+        assert not {"py", "bzl", "vflake", "ncl", "starlark"} & set(
+            valiantOpts._methods
+        )
+
+
+@mark.opts
+class TestConcurrency:
+    @fixture
+    def processSH(self, fakeSH):
+        def processSH(barrier=None, event=None):
+            def process(output):
+                def run(*args, expr="", **kwargs):
+                    if barrier:
+                        barrier.wait(5)
+                    if event:
+                        assert event.wait(5)
+                    return f'{{"opts": {output}}}' if "opts =" in expr else output
+
+                return run
+
+            return fakeSH(
+                dict(
+                    cue=process('{"dirs": ["cue"]}'),
+                    nickel=process('dirs = ["nickel"]'),
+                    nix=process('{"dirs": ["nix"], "nix": true}'),
+                )
+            )
+
+        return processSH
+
+    @fixture
+    def directory(self, tmp_path):
+        for ext in ("cue", "ncl", "nix"):
+            (tmp_path / f"valiant.{ext}").write_text("...")
+        (tmp_path / "valiant.json").write_text('{"dirs": ["json"]}')
+        return tmp_path
+
+    def test_concurrent(self, directory, processSH, tmp_path):
+        # NOTE: The barrier only opens once all three processes run at once.
+        opts = Opts("valiant", sh=processSH(Barrier(3)), refresh=True, cache=tmp_path)
+        assert opts(directory=directory, all_formats=True) == dict(
+            dirs=["cue", "json", "nickel", "nix"], nix=True
+        )
+
+    # NOTE: The processes only finish once `valiant.json' has been parsed,
+    #       which must not wait on them.
+    def test_inprocess(self, directory, processSH, tmp_path, monkeypatch):
+        event = Event()
+        json = Opts.json
+
+        def parse(self, *args, **kwargs):
+            try:
+                return json(self, *args, **kwargs)
+            finally:
+                event.set()
+
+        monkeypatch.setattr(Opts, "json", parse)
+        opts = Opts("valiant", sh=processSH(event=event), refresh=True, cache=tmp_path)
+        assert opts(directory=directory, all_formats=True) == dict(
+            dirs=["cue", "json", "nickel", "nix"], nix=True
+        )
+
+    def test_order(self, directory, processSH, tmp_path):
+        assert Opts("valiant", sh=processSH(), refresh=True, cache=tmp_path, jobs=1)(
+            directory=directory, all_formats=True
+        ) == Opts("valiant", sh=processSH(), refresh=True, cache=tmp_path)(
+            directory=directory, all_formats=True
+        )
+
+
+@mark.benchmark
+@mark.skipif(
+    not all(map(which, ("cue", "nickel", "nix"))),
+    reason="Needs every external options format.",
+)
+@mark.skipif(building, reason="Fails in a nix chroot because of flake sandbox.")
+def test_benchmark(resources, tmp_path):
+    directory = tmp_path / "all"
+    directory.mkdir()
+    for template in (resources / "directory_templates").iterdir():
+        if template.is_dir():
+            for file in template.iterdir():
+                if file.is_file():
+                    copy(file, directory)
+    timings = dict()
+    results = dict()
+    for jobs in (1, None):
+        opts = Opts("valiant", refresh=True, cache=tmp_path / "cache", jobs=jobs)
+        start = perf_counter()
+        results[jobs] = opts(directory=directory, all_formats=True)
+        timings[jobs] = perf_counter() - start
+    print(f"sequential: {timings[1]:.3f}s, concurrent: {timings[None]:.3f}s")
+    assert results[1] == results[None]
+
+
+@mark.opts
+class TestCombined:
+    @fixture
+    def nixSH(self, fakeSH):
+        def nixSH(fail=False):
+            def run(*args, expr, **kwargs):
+                if "toJSON {" in expr:
+                    if fail:
+                        raise RuntimeError(expr)
+                    return '{"opts": {"dirs": ["nix"]}, "vflake": {"valiant": true}, "flake": {"pname": "p"}}'
+                return '{"dirs": ["separate"]}'
+
+            return fakeSH({"nix.eval": run})
+
+        return nixSH
+
+    @fixture
+    def directory(self, tmp_path):
+        for name in ("valiant.nix", "vflake.nix", "flake.nix"):
+            (tmp_path / name).write_text("{ }")
+        return tmp_path
+
+    def test_single(self, directory, nixSH, tmp_path):
+        sh = nixSH()
+        assert nixEvaluation(directory, sh=sh, cache=tmp_path).flake == dict(pname="p")
+        assert Opts("valiant", sh=sh, refresh=True, cache=tmp_path)(
+            directory=directory, format=("nix", "flake")
+        ) == dict(dirs=["nix"], valiant=True)
+        assert len(sh.exprs) == 1
+        assert all(part in sh.exprs[0] for part in ("opts =", "vflake =", "flake ="))
+
+    def test_parts(self, directory, nixSH, tmp_path):
+        sh = nixSH()
+        Opts("valiant", sh=sh, refresh=True, cache=tmp_path)(
+            directory=directory, format=("nix", "flake")
+        )
+        assert len(sh.exprs) == 1
+        assert "flake =" not in sh.exprs[0].replace("vflake =", "")
+        assert nixEvaluation(
+            directory, sh=sh, cache=tmp_path, parts=("opts", "flake")
+        ).flake == dict(pname="p")
+        assert len(sh.exprs) == 2
+        assert "opts =" not in sh.exprs[1]
+
+    def test_warm(self, directory, nixSH, tmp_path_factory):
+        sh = nixSH()
+        cache = tmp_path_factory.mktemp("cache")
+        for _ in range(2):
+            nixEvaluations.clear()
+            sh.calls.clear()
+            workspace = Workspace(
+                (directory,),
+                sh=sh,
+                optsParser=Opts("valiant", sh=sh, cache=cache),
+                cache=cache,
+            )
+        assert workspace.nodes[directory].flake == dict(pname="p")
+        assert workspace.nodes[directory].opts.valiant
+        assert not sh.exprs
+
+    def test_fallback(self, directory, nixSH, tmp_path):
+        sh = nixSH(fail=True)
+        assert Opts("valiant", sh=sh, refresh=True, cache=tmp_path)(
+            directory=directory, format="nix"
+        ) == dict(dirs=["separate"])
+        assert (
+            nixEvaluation(directory, sh=sh, cache=tmp_path, parts=("opts", "vflake"))
+            is None
+        )
+        assert len(sh.exprs) == 2
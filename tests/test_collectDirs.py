@@ -1,14 +1,20 @@
 import orjson as json
 import pickle
 import random
+from addict import Dict
 from collections import defaultdict, namedtuple
 from os import environ
-from pathlib import Path
+from parametrized import parametrized
+from pathlib import Path, PurePosixPath
 from pytest import mark, fixture
+from shutil import which
+from subprocess import run
 from rich.pretty import pprint
 from string import ascii_lowercase
 from tempfile import TemporaryDirectory
-from valiant import collectDirs
+from threading import Barrier
+from valiant import Workspace, collectDirs
+from valiant.workspace import compileGlobs, gitToplevel, gitToplevels
 from functools import partial
 
 
@@ -16,8 +22,10 @@ from functools import partial
 @mark.xdist_group(name="nix")
 class TestCollectDirs:
     @fixture
-    def collect(self, valiantOpts, scope="class"):
-        return partial(collectDirs, optsParser=valiantOpts)
+    def collect(self, valiantOpts, tmp_path_factory, scope="class"):
+        return partial(
+            collectDirs, optsParser=valiantOpts, cache=tmp_path_factory.mktemp("cache")
+        )
 
     def test_collect(self):
         pass
@@ -29,6 +37,161 @@ class TestCollectDirs:
         )
 
 
+class DirsParser:
+    _name = "valiant"
+
+    def __init__(self, dirs):
+        self.dirs = dirs
+        self.calls = defaultdict(int)
+        self.barrier = None
+
+    def __call__(self, directory, **kwargs):
+        if self.barrier and (directory.name in ("a", "e")):
+            self.barrier.wait(5)
+        self.calls[directory.name] += 1
+        return Dict(dirs=[str(directory / ".." / d) for d in self.dirs[directory.name]])
+
+
+@mark.collectDirs
+class TestWorkspace:
+    @fixture
+    def parser(self, tmp_path):
+        dirs = dict(a=["b", "c"], b=["c", "d"], c=["a"], d=[], e=["d"])
+        for d in dirs:
+            (tmp_path / d).mkdir()
+            (tmp_path / d / ".valiant").touch()
+        return DirsParser(dirs)
+
+    @fixture
+    def workspace(self, parser, tmp_path):
+        return Workspace(
+            (tmp_path / "a", tmp_path / "e"), optsParser=parser, cache=None
+        )
+
+    def test_once(self, workspace, parser):
+        assert dict(parser.calls) == dict(a=1, b=1, c=1, d=1, e=1)
+
+    def test_order(self, workspace):
+        assert [d.name for d in workspace.order] == ["a", "e", "b", "c", "d"]
+
+    def test_dag(self, workspace, tmp_path):
+        assert workspace.cycles == [(tmp_path / "c", tmp_path / "a")]
+        assert {
+            k.name: [d.name for d in v] for k, v in workspace.edges.items()
+        } == dict(a=["b", "c"], b=["c", "d"], c=[], d=[], e=["d"])
+
+    def test_collect(self, workspace, tmp_path):
+        assert [d.name for d in workspace.collect(tmp_path / "a")] == [
+            "c",
+            "d",
+            "b",
+            "a",
+        ]
+        assert [d.name for d in workspace.collect(tmp_path / "e")] == ["d", "e"]
+
+    def test_skip_dependencies(self, parser, tmp_path):
+        workspace = Workspace(
+            {tmp_path / "a": None},
+            optsParser=parser,
+            skip_dependencies=True,
+            cache=None,
+        )
+        assert list(workspace.collect()) == [tmp_path / "a"]
+        assert dict(parser.calls) == dict(a=1)
+
+    def test_manifest(self, parser, tmp_path):
+        cache = tmp_path / "cache"
+        workspace = partial(
+            Workspace, (tmp_path / "a",), optsParser=parser, cache=cache
+        )
+        first = workspace()
+        assert (cache / ".valiant-workspace.json").exists()
+        second = workspace()
+        assert dict(parser.calls) == dict(a=1, b=1, c=1, d=1)
+        assert second.edges == first.edges
+        assert second.collect() == first.collect()
+        (tmp_path / "b" / "valiant.json").write_text("{}")
+        workspace()
+        workspace(refresh=True)
+        assert dict(parser.calls) == dict(a=2, b=3, c=2, d=2)
+
+    def test_flakes(self, parser, tmp_path, monkeypatch):
+        calls = []
+
+        def getFlakes(directories, cache, **kwargs):
+            calls.append((sorted(d.name for d in directories), cache))
+            return {d: Dict(pname=d.name) for d in directories}
+
+        def nixEvaluation(directory, cache, **kwargs):
+            return Dict(flake=getFlakes((directory,), cache)[directory])
+
+        monkeypatch.setattr("valiant.workspace.getFlakes", getFlakes)
+        monkeypatch.setattr("valiant.workspace.nixEvaluation", nixEvaluation)
+        cache = tmp_path / "cache"
+        workspaces = [
+            Workspace((tmp_path / "a",), optsParser=parser, cache=c)
+            for c in (None, cache, cache)
+        ]
+        assert calls == [
+            (names, c)
+            for c in (None, cache, cache)
+            for names in (["a"], ["b", "c"], ["d"])
+        ]
+        assert dict(parser.calls) == dict(a=2, b=2, c=2, d=2)
+        assert workspaces[2].nodes == workspaces[1].nodes
+        assert "flake" not in workspaces[1].manifest.get(tmp_path / "a")
+
+    def test_jobs(self, parser, tmp_path):
+        # NOTE: The barrier only opens once both roots are parsed at once.
+        parser.barrier = Barrier(2)
+        workspace = Workspace(
+            (tmp_path / "a", tmp_path / "e"), optsParser=parser, cache=None, jobs=2
+        )
+        parser.barrier = None
+        sequential = Workspace(
+            (tmp_path / "a", tmp_path / "e"), optsParser=parser, cache=None, jobs=1
+        )
+        assert workspace.order == sequential.order
+        assert workspace.edges == sequential.edges
+        assert workspace.collect() == sequential.collect()
+
+    def test_flakes_first(self, parser, tmp_path, monkeypatch):
+        events = []
+
+        def getFlakes(self, directories, unloaded=tuple()):
+            events.append(("flakes", sorted(d.name for d in directories)))
+            return {d: Dict() for d in directories}
+
+        def getOpts(self, directory):
+            events.append(("opts", directory.name))
+            return Dict()
+
+        monkeypatch.setattr(Workspace, "getFlakes", getFlakes)
+        monkeypatch.setattr(Workspace, "getOpts", getOpts)
+        Workspace((tmp_path / "a", tmp_path / "e"), cache=None, jobs=2)
+        assert events[0] == ("flakes", ["a", "e"])
+        assert sorted(events[1:]) == [("opts", "a"), ("opts", "e")]
+
+    def test_dependencies(self, parser, tmp_path):
+        workspace = Workspace(
+            (tmp_path / "a",), optsParser=parser, cache=None, dependencies=("c",)
+        )
+        assert list(workspace.collect()) == [tmp_path / "c"]
+
+    def test_selfListed(self, tmp_path):
+        repo = tmp_path / "repo"
+        (repo / ".git").mkdir(parents=True)
+        (repo / "sub").mkdir()
+        parser = DirsParser(dict(repo=["repo", "repo/sub"], sub=[]))
+        workspace = Workspace((repo,), optsParser=parser, cache=None)
+        assert repo not in workspace.edges[repo]
+        assert list(workspace.collect()) == [repo]
+        (repo / "sub" / ".valiant").touch()
+        parser.dirs["repo"] = ["repo/sub"]
+        workspace = Workspace((repo,), optsParser=parser, cache=None)
+        assert list(workspace.collect()) == [repo / "sub"]
+
+
 # @mark.collectDirs
 # @mark.skip
 # def test_collectAllDirs(templates, sumOfDirs):
@@ -76,3 +239,71 @@ class TestCollectDirs:
 #     finally:
 #         for directory in dirs.values():
 #             directory.dir.cleanup()
+
+
+@mark.collectDirs
+@mark.skipif(not which("git"), reason="Requires git.")
+class TestToplevel:
+    @fixture
+    def repository(self, tmp_path, monkeypatch):
+        for variable in ("GIT_DIR", "GIT_WORK_TREE", "GIT_CEILING_DIRECTORIES"):
+            monkeypatch.delenv(variable, raising=False)
+        gitToplevels.clear()
+        repository = tmp_path / "repository"
+        (repository / "sub" / "dir").mkdir(parents=True)
+        run(["git", "init", "-q", repository], check=True)
+        return repository.resolve()
+
+    # NOTE: Fails on any command, so git is never spawned.
+    @fixture
+    def sh(self, fakeSH):
+        return fakeSH()
+
+    def rev_parse(self, directory):
+        return Path(
+            run(
+                ["git", "-C", directory, "rev-parse", "--show-toplevel"],
+                capture_output=True,
+                text=True,
+            ).stdout.strip()
+            or "."
+        ).resolve()
+
+    def test_repository(self, repository, sh):
+        for directory in (repository, repository / "sub", repository / "sub" / "dir"):
+            assert gitToplevel(directory, sh=sh) == self.rev_parse(directory)
+        assert gitToplevels
+
+    def test_gitdir(self, repository, sh, tmp_path):
+        (tmp_path / "modules" / "linked").mkdir(parents=True)
+        linked = repository / "sub"
+        (linked / ".git").write_text("gitdir: ../../modules/linked\n")
+        assert gitToplevel(linked / "dir", sh=sh) == linked
+
+    def test_ceiling(self, repository, sh, monkeypatch):
+        monkeypatch.setenv("GIT_CEILING_DIRECTORIES", str(repository / "sub"))
+        assert gitToplevel(repository / "sub", sh=sh) == repository
+        assert gitToplevel(repository / "sub" / "dir", sh=sh) is None
+
+    def test_fallback(self, repository):
+        assert gitToplevel(repository / ".git") is None
+
+
+@mark.collectDirs
+class TestGlobs:
+    paths = ("/a", "/a/b", "/a/b/c", "/a/x/c", "/xyz", "/]x", "/[a", "/a.b", "/q/a/b")
+
+    @parametrized
+    def test_match(
+        self,
+        glob=("b", "a/b", "/a/*", "/a", "*.py", "[ab]*", "[!a]*", "x?z", "a/*/c"),
+    ):
+        matcher = compileGlobs([glob])
+        assert [bool(matcher.search(p)) for p in self.paths] == [
+            PurePosixPath(p).match(glob) for p in self.paths
+        ]
+
+    def test_combined(self):
+        matcher = compileGlobs(["/a/b", "x?z"])
+        assert [p for p in self.paths if matcher.search(p)] == ["/a/b", "/xyz"]
+        assert compileGlobs([]) is None
@@ -0,0 +1,41 @@
+from parametrized import parametrized
+from pytest import fixture, mark
+from valiant.formatter import formatPython, poolThreshold
+
+
+@mark.formatter
+class TestFormatPython:
+    @fixture
+    def files(self, tmp_path):
+        files = dict(
+            formatted=tmp_path / "formatted.py",
+            unformatted=tmp_path / "unformatted.py",
+            broken=tmp_path / "broken.py",
+        )
+        files["formatted"].write_text("a = 0\n")
+        files["unformatted"].write_text("b=[1,\n2]\n")
+        files["broken"].write_text("def (:\n")
+        return files
+
+    @parametrized.product
+    def test_format(
+        self, files, tmp_path, workers=(1, 2), threshold=(1, poolThreshold)
+    ):
+        mtime = files["formatted"].stat().st_mtime_ns
+        code, results = formatPython(
+            map(str, files.values()), tmp_path, workers=workers, threshold=threshold
+        )
+        assert code == 123
+        assert {file: status for file, status, _ in results} == {
+            str(files["formatted"]): "unchanged",
+            str(files["unformatted"]): "reformatted",
+            str(files["broken"]): "failed",
+        }
+        assert files["unformatted"].read_text() == "b = [1, 2]\n"
+        assert files["formatted"].stat().st_mtime_ns == mtime
+
+    def test_pyproject(self, files, tmp_path):
+        (tmp_path / "pyproject.toml").write_text("[tool.black]\nline-length = 5\n")
+        code, _ = formatPython((str(files["unformatted"]),), tmp_path)
+        assert code == 0
+        assert files["unformatted"].read_text() == "b = [\n    1,\n    2,\n]\n"
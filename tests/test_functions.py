@@ -1,7 +1,14 @@
+import orjson as json
+import re
+
+from functools import partial
 from os import environ
 from parametrized import parametrized
 from pytest import fixture, mark
+from shutil import which
+from subprocess import run
 from tempfile import TemporaryFile
+from valiant.manifest import flakeSource, readFlakeSource
 from valiant.miscellaneous import (
     any_in,
     all_in,
@@ -15,14 +22,19 @@ from valiant.miscellaneous import (
     escapeQuotesJoinMapString,
     escapeSingleQuotes,
     format_conf,
+    getCurrentSystem,
+    getFlake,
+    getFlakes,
     getFuncDefaults,
     is_coll,
     module_installed,
     normalizeMultiline,
+    platformSystem,
     toColl,
     update,
     updateWithStrings,
 )
+from valiant.path import SuperPath
 
 
 @mark.anyAllIn
@@ -60,6 +72,38 @@ class TestGetFuncDefaults:
         assert getFuncDefaults(self.func).defaults.b is None
 
 
+@mark.currentSystem
+class TestCurrentSystem:
+    @fixture
+    def sh(self, fakeSH):
+        return fakeSH({"nix.eval": "riscv64-linux"})
+
+    @fixture
+    def nix(self, tmp_path):
+        nix = tmp_path / "nix"
+        nix.touch()
+        return nix
+
+    def test_fallback(self, tmp_path):
+        assert (
+            getCurrentSystem(nix=tmp_path / "missing", cache=tmp_path / "cache.json")
+            == platformSystem()
+        )
+
+    def test_cache(self, sh, nix, tmp_path):
+        cache = tmp_path / "cache.json"
+        for _ in range(2):
+            assert getCurrentSystem(sh=sh, nix=nix, cache=cache) == "riscv64-linux"
+        assert len(sh.called("nix.eval")) == 1
+
+    def test_invalidate(self, sh, nix, tmp_path):
+        cache = tmp_path / "cache.json"
+        getCurrentSystem(sh=sh, nix=nix, cache=cache)
+        nix.write_text("nix")
+        getCurrentSystem(sh=sh, nix=nix, cache=cache)
+        assert len(sh.called("nix.eval")) == 2
+
+
 @mark.toColl
 @mark.order(0)
 @parametrized.zip
@@ -69,8 +113,31 @@ def test_toColl(func=(list, set, tuple, dict), output=([0], {0}, (0,), {0: None}
 
 @mark.module_installed
 @parametrized
-def test_module_installed(resources, ext=("py", "bzl")):
-    assert module_installed(resources / f"valiant.{ext}", ext).dirs == ["./."]
+def test_module_installed(resources, tmp_path, ext=("py", "bzl")):
+    assert module_installed(resources / f"valiant.{ext}", ext, cache=tmp_path).dirs == [
+        "./."
+    ]
+
+
+@mark.module_installed
+def test_module_cache(tmp_path):
+    from importlib.machinery import SOURCE_SUFFIXES
+
+    suffixes = list(SOURCE_SUFFIXES)
+    file = tmp_path / "valiant.bzl"
+    file.write_text("dirs = ['./.']\n")
+    cache = tmp_path / "cache"
+    assert module_installed(file, cache=cache).__file__ == str(file)
+    assert len(list(cache.iterdir())) == 1
+    assert module_installed(file, cache=cache).dirs == ["./."]
+    assert len(list(cache.iterdir())) == 1
+    file.write_text("dirs = ['..']\n")
+    assert module_installed(file, cache=cache).dirs == [".."]
+    assert len(list(cache.iterdir())) == 1
+    assert module_installed(file).dirs == [".."]
+    assert len(list(cache.iterdir())) == 1
+    assert module_installed(file, cache=cache).dirs == [".."]
+    assert SOURCE_SUFFIXES == suffixes
 
 
 @mark.conf
@@ -393,3 +460,148 @@ class TestUpdate:
         assert getattr(updateWithStrings(dict(a="z", b="b"), dict(a="a", c="c")), eq)(
             output
         )
+
+
+@mark.getFlake
+class TestGetFlake:
+    @fixture
+    def sh(self, fakeSH):
+        return fakeSH({"nix.eval": json.dumps(dict(pname="flake"))})
+
+    # NOTE: Batches fail with `output' set to `None',
+    #       while single flakes always evaluate.
+    @fixture
+    def batchSH(self, fakeSH):
+        def batchSH(output):
+            def run(*args, expr, **kwargs):
+                if "tryEval" not in expr:
+                    return json.dumps(dict(pname="flake"))
+                if output is None:
+                    raise RuntimeError(expr)
+                return output
+
+            return fakeSH({"nix.eval": run})
+
+        return batchSH
+
+    @fixture
+    def directory(self, tmp_path):
+        (tmp_path / "flake.nix").write_text("{ outputs = { self }: { }; }")
+        return tmp_path
+
+    def test_selective(self, directory, sh):
+        assert getFlake(
+            directory=directory, sh=sh, attrs=("pname", "a.b"), cache=None
+        ).pname == ("flake")
+        assert '[ [ "pname" ] [ "a" "b" ] ]' in sh.exprs[0]
+        assert "removeNonJSON (getFlake'" not in sh.exprs[0]
+
+    def test_full(self, directory, sh):
+        getFlake(directory=directory, sh=sh, full=True, cache=None)
+        assert "removeNonJSON (getFlake'" in sh.exprs[0]
+        assert "select [" not in sh.exprs[0]
+
+    def test_cached(self, directory, sh, tmp_path, monkeypatch):
+        cache = tmp_path / "cache"
+        for _ in range(2):
+            assert getFlake(directory=directory, sh=sh, cache=cache).pname == "flake"
+        assert len(sh.exprs) == 1
+        getFlake(directory=directory, sh=sh, cache=cache, full=True)
+        assert len(sh.exprs) == 2
+        monkeypatch.setenv("NIX_CONFIG", "pure-eval = false")
+        getFlake(directory=directory, sh=sh, cache=cache)
+        assert len(sh.exprs) == 3
+        (directory / "flake.lock").write_text("{}")
+        getFlake(directory=directory, sh=sh, cache=cache)
+        getFlake(directory=directory, sh=sh, cache=cache, refresh=True)
+        assert len(sh.exprs) == 5
+
+    @fixture
+    def directories(self, tmp_path):
+        directories = [tmp_path / d for d in ("a", "b", "c")]
+        for directory in directories:
+            directory.mkdir()
+        for directory in directories[:2]:
+            (directory / "flake.nix").write_text("{ }")
+        return directories
+
+    def test_batch(self, directories, batchSH):
+        sh = batchSH(json.dumps({str(directories[0]): dict(pname="a")}))
+        assert getFlakes(directories, sh=sh, cache=None) == {
+            directories[0]: dict(pname="a"),
+            directories[1]: dict(),
+            directories[2]: dict(),
+        }
+        assert len(sh.exprs) == 1
+        assert str(directories[2]) not in sh.exprs[0]
+
+        # NOTE: Unqualified builtins would be looked up in `lib' first.
+        body = sh.exprs[0][sh.exprs[0].index("paths);") :]
+        assert not re.search(
+            r"(?<!builtins\.)\b(toJSON|mapAttrs|tryEval|deepSeq)\b", body
+        )
+
+    def test_batch_fallback(self, directories, batchSH):
+        sh = batchSH(None)
+        assert getFlakes(directories, sh=sh, cache=None) == {
+            directories[0]: dict(pname="flake"),
+            directories[1]: dict(pname="flake"),
+            directories[2]: dict(),
+        }
+        assert len(sh.exprs) == 3
+
+    @mark.nix
+    @mark.skipif(not which("nix"), reason="Requires nix.")
+    def test_nix(self, tmp_path):
+        (tmp_path / "flake.nix").write_text(
+            '{ outputs = { self }: { pname = "p"; a.b = 1; a.c = x: x; lib = { }; }; }'
+        )
+        assert getFlake(
+            directory=tmp_path, attrs=("pname", "a.b", "type"), cache=None
+        ) == dict(pname="p", a=dict(b=1), type=None)
+
+
+@mark.getFlake
+@mark.skipif(not which("git"), reason="Requires git.")
+class TestFlakeSource:
+    @fixture
+    def repository(self, tmp_path, monkeypatch):
+        for variable in ("GIT_DIR", "GIT_WORK_TREE", "GIT_INDEX_FILE"):
+            monkeypatch.delenv(variable, raising=False)
+        for name in ("flake.nix", "lib.nix"):
+            (tmp_path / name).write_text("{ }")
+        git = partial(run, cwd=tmp_path, check=True, capture_output=True)
+        git(["git", "init", "-q"])
+        git(["git", "add", "."])
+        git(
+            [
+                "git",
+                "-c",
+                "user.name=valiant",
+                "-c",
+                "user.email=valiant@example.com",
+                "commit",
+                "-qm",
+                "flake",
+            ]
+        )
+        return SuperPath(tmp_path)
+
+    def test_memoized(self, repository, fakeSH):
+        sh = fakeSH(dict(git=""))
+        assert flakeSource(repository, sh) == flakeSource(repository, sh) == "tree:"
+        assert len(sh.calls) == 2
+        (repository / "flake.lock").write_text("{}")
+        flakeSource(repository, sh)
+        assert len(sh.calls) == 4
+
+    def test_dirty(self, repository):
+        clean = readFlakeSource(repository)
+        assert clean.startswith("tree:")
+        (repository / "lib.nix").write_text("{ a = 1; }")
+        dirty = readFlakeSource(repository)
+        assert dirty.startswith("diff:")
+        (repository / "lib.nix").write_text("{ a = 2; }")
+        assert readFlakeSource(repository) not in (clean, dirty)
+        (repository / "lib.nix").write_text("{ }")
+        assert readFlakeSource(repository) == clean
@@ -0,0 +1,290 @@
+from addict import Dict
+from os import utime
+from pytest import fixture, mark, raises
+from pathlib import Path
+from threading import Event
+from valiant.gauntlet import Gauntlet
+from valiant.org import tangleTargets
+from valiant.path import SuperPath
+
+
+@fixture
+def sh(fakeSH):
+    return fakeSH(default="")
+
+
+# NOTE: Kept outside of the project, as the gauntlet walks it.
+@fixture
+def cache(tmp_path_factory):
+    return tmp_path_factory.mktemp("cache")
+
+
+@fixture
+def gauntlet(tmp_path, sh, cache):
+    return Gauntlet(tmp_path, sh=sh, flake=Dict(pname="test"), opts=Dict(), cache=cache)
+
+
+@mark.gauntlet
+class TestStages:
+    def test_overlap(self, gauntlet):
+        started = Event()
+        gauntlet.stage("first", started.wait, 5)
+        gauntlet.stage("second", started.set)
+        assert gauntlet.barrier("first", "second") == (True, None)
+        assert not gauntlet.stages
+
+    def test_after(self, gauntlet):
+        order = []
+        gauntlet.stage("first", lambda: Event().wait(0.1) or order.append("first"))
+        gauntlet.stage("second", order.append, "second", after=("first", "missing"))
+        gauntlet.barrier()
+        assert order == ["first", "second"]
+
+    def test_barrier(self, gauntlet):
+        gauntlet.stage("failing", int, "a")
+        assert gauntlet.barrier("missing") == (None,)
+        with raises(ValueError):
+            gauntlet.barrier()
+        assert not gauntlet.stages
+
+
+@mark.gauntlet
+class TestPhases:
+    def test_failure(self, gauntlet, monkeypatch):
+        def flakePhase(self):
+            raise ValueError("flake")
+
+        monkeypatch.setattr(Gauntlet, "flakePhase", flakePhase)
+        for _ in range(2):
+            with raises(ValueError):
+                gauntlet.ensure("flake")
+        assert "flake" not in gauntlet.completed_phases
+        assert not gauntlet.running_phases
+
+    def test_requiredPhases(self, sh, cache, tmp_path, monkeypatch):
+        from valiant import requiredPhases
+
+        ran = []
+        monkeypatch.setattr(Gauntlet, "flakePhase", lambda self: ran.append("flake"))
+        assert requiredPhases("flake")(lambda: None).phases == ("flake",)
+        g = Gauntlet(
+            tmp_path,
+            sh=sh,
+            flake=Dict(pname="test"),
+            opts=Dict(),
+            phases=(),
+            cache=cache,
+        )
+        g.ensure()
+        assert not ran
+        g.ensure("flake")
+        g.ensure("flake")
+        assert ran == ["flake"]
+        assert g.completed_phases == {"flake"}
+
+    def test_values(self, gauntlet, monkeypatch):
+        ran = []
+        monkeypatch.setattr(Gauntlet, "ensure", lambda self, *names: ran.extend(names))
+        monkeypatch.setattr(
+            Gauntlet, "mkShell", lambda self, **kwargs: ran.append("shell")
+        )
+        values = gauntlet.values("echo {dir}")
+        assert not ran
+        assert not set(values).intersection(("shell", "pureshell", "quickshell"))
+        assert "projectName" in gauntlet.values("echo {projectName.upper}")
+        assert "flake" in ran and "shell" not in ran
+
+    def test_shells(self, gauntlet, monkeypatch):
+        built = []
+        monkeypatch.setattr(
+            Gauntlet, "mkShell", lambda self, **kwargs: built.append(kwargs) or kwargs
+        )
+        assert not gauntlet.cache
+        assert gauntlet.pureshell is gauntlet.pureshell
+        assert built == [dict(pure=True)]
+        assert "shell" not in gauntlet.cache
+
+    def test_tangle_format(self, sh, cache, tmp_path, monkeypatch):
+        events = []
+
+        def formatParts(self, ext, files):
+            events.append("format")
+            Event().wait(0.2)
+            for file in files:
+                Path(file).write_text("formatted\n")
+            events.append("formatted")
+            return files
+
+        def tangle(*files):
+            events.append("tangle")
+            for file in files:
+                for target in tangleTargets(file):
+                    target.write_text("tangled\n")
+
+        monkeypatch.setattr(Gauntlet, "formatParts", formatParts)
+        for name, target in (("README.org", "a.py"), ("extra.org", "b.py")):
+            (tmp_path / name).write_text(
+                f"#+begin_src python :tangle {target}\n#+end_src\n"
+            )
+        g = Gauntlet(
+            tmp_path,
+            sh=sh,
+            cache=cache,
+            flake=Dict(pname="extra.org"),
+            opts=Dict(tangle=Dict(enable=True)),
+            phases=("tangle", "flake", "format"),
+            force=True,
+        )
+        g.org_tangle = tangle
+        g.ensure()
+        assert events == [
+            "tangle",
+            "format",
+            "formatted",
+            "tangle",
+            "format",
+            "formatted",
+        ]
+        for file in ("a.py", "b.py"):
+            assert (tmp_path / file).read_text() == "formatted\n"
+            assert not g.formatStale(str(tmp_path / file))
+        for source in ("README.org", "extra.org"):
+            assert not g.tangleStale(tmp_path / source)
+
+    def test_rehashTangled(self, gauntlet, tmp_path):
+        outputs = dict()
+        for name in ("a.py", "b.py"):
+            (tmp_path / name).write_text(name)
+            outputs[str(tmp_path / name)] = "stale"
+        gauntlet.tangleManifest[tmp_path / "README.org"] = dict(
+            hash="", opaque=False, outputs=outputs
+        )
+        gauntlet.recordFormatted((str(tmp_path / "a.py"),))
+        gauntlet.rehashTangled()
+        assert gauntlet.tangleManifest[tmp_path / "README.org"]["outputs"] == {
+            str(tmp_path / "a.py"): SuperPath(tmp_path / "a.py").xxhexdigest(),
+            str(tmp_path / "b.py"): "stale",
+        }
+        assert not gauntlet.formatted
+
+
+@mark.gauntlet
+class TestFormat:
+    @fixture
+    def files(self, tmp_path):
+        files = dict()
+        for name in ("a.py", "sub/b.py", "ignored.py", "c.nix"):
+            files[name] = tmp_path / name
+        for name in (".git/d.py", "dt/e.py", "directory_templates/f.py", "sub/dt/g.py"):
+            files[name] = tmp_path / name
+        for file in files.values():
+            file.parent.mkdir(parents=True, exist_ok=True)
+            file.write_text("a = 0\n")
+        return files
+
+    def test_excluded_parts(self, files, sh, cache, tmp_path):
+        gauntlet = Gauntlet(
+            tmp_path,
+            sh=sh,
+            cache=cache,
+            flake=Dict(pname="test"),
+            opts=Dict(format=Dict(py=Dict(ignore=[str(files["ignored.py"])]))),
+        )
+        assert sorted(gauntlet.excluded_parts("py")) == [
+            str(files["a.py"]),
+            str(files["sub/b.py"]),
+        ]
+        assert list(gauntlet.excluded_parts("nix")) == [str(files["c.nix"])]
+
+    def test_stale(self, gauntlet, files):
+        file = str(files["a.py"])
+        assert file in gauntlet.changed_parts("py")
+        gauntlet.recordFormatted(gauntlet.changed_parts("py"))
+        assert not gauntlet.changed_parts("py")
+
+        # NOTE: Only the modification time changes here.
+        stat = files["a.py"].stat()
+        utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert not gauntlet.formatStale(file)
+        assert gauntlet.formatManifest[file][1] == stat.st_mtime_ns + 10**9
+
+        files["a.py"].write_text("a = 1\n")
+        assert gauntlet.changed_parts("py") == [file]
+
+    # NOTE: No formatter may rewrite the tree while the flake copies it.
+    def test_flake(self, gauntlet, files, monkeypatch):
+        copied = Event()
+        formatted = []
+
+        def formatParts(self, ext, files):
+            formatted.append((ext, copied.is_set()))
+
+        monkeypatch.setattr(Gauntlet, "formatParts", formatParts)
+        gauntlet.stage("getFlake", lambda: Event().wait(0.1) or copied.set())
+        gauntlet.startFormat()
+        gauntlet.barrier()
+        assert sorted(formatted) == [("nix", True), ("py", True)]
+
+    def test_refresh(self, gauntlet, files, sh, cache, tmp_path):
+        gauntlet.recordFormatted(gauntlet.changed_parts("py"))
+        refreshed = Gauntlet(
+            tmp_path,
+            sh=sh,
+            flake=Dict(pname="test"),
+            opts=Dict(),
+            refresh=True,
+            cache=cache,
+        )
+        assert not gauntlet.changed_parts("py")
+        assert sorted(refreshed.changed_parts("py")) == sorted(
+            gauntlet.excluded_parts("py")
+        )
+
+
+@mark.gauntlet
+class TestExport:
+    @fixture
+    def include(self, tmp_path):
+        def include(name, *includes, output=None):
+            lines = [f"#+INCLUDE: {i}.org" for i in includes]
+            if output:
+                lines.append(f"#+EXPORT_FILE_NAME: {output}")
+            (tmp_path / f"{name}.org").write_text("\n".join(lines) + "\n")
+            return SuperPath(tmp_path / f"{name}.org")
+
+        return include
+
+    def test_chain(self, gauntlet, include):
+        files = [include("a", "b"), include("b", "c"), include("c")]
+        a, b, c = files
+        assert gauntlet.planExport(files) == [c, b, a]
+        gauntlet.recordExported(files)
+        assert gauntlet.planExport(files) == []
+        c.write_text("changed\n")
+        assert gauntlet.planExport(files) == [c, b, a]
+        assert gauntlet.planExport((a, b)) == [b, a]
+
+    def test_diamond(self, gauntlet, include):
+        files = [
+            include("top", "left", "right"),
+            include("left", "base"),
+            include("right", "base"),
+            include("base"),
+        ]
+        top, left, right, base = files
+        gauntlet.recordExported(files)
+        left.write_text(left.read_text() + "changed\n")
+        assert gauntlet.planExport(files) == [left, top]
+        gauntlet.recordExported(files)
+        base.write_text("changed\n")
+        plan = gauntlet.planExport(files)
+        assert sorted(plan) == sorted(files)
+        assert plan[0] == base and plan[-1] == top
+
+    def test_outputs(self, gauntlet, include, tmp_path):
+        index = include("index", output="index.md")
+        (tmp_path / "index.md").touch()
+        gauntlet.recordExported((index,))
+        assert gauntlet.planExport((index,)) == []
+        (tmp_path / "index.md").unlink()
+        assert gauntlet.planExport((index,)) == [index]
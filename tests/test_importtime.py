@@ -0,0 +1,54 @@
+import sys
+
+from parametrized import parametrized
+from pytest import mark
+from subprocess import run
+
+# NOTE: In microseconds, as reported by `python -X importtime'.
+budget = 750_000
+
+
+def python(*args):
+    return run(
+        (sys.executable, *args),
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+
+
+@mark.importtime
+class TestImportTime:
+    def test_budget(self):
+        for line in python("-X", "importtime", "-c", "import valiant").stderr.split(
+            "\n"
+        ):
+            split = line.split("|")
+            if (len(split) == 3) and (split[2].strip() == "valiant"):
+                assert int(split[1]) < budget
+                break
+        else:
+            raise AssertionError("`valiant' was not imported!")
+
+    @parametrized
+    def test_deferred(
+        self,
+        module=(
+            "_jsonnet",
+            "black",
+            "concurrent.futures.process",
+            "dhall",
+            "multiprocessing",
+            "poetry2setup",
+            "rapidjson",
+            "rich.traceback",
+            "xmltodict",
+            "yaml",
+        ),
+    ):
+        assert (
+            python(
+                "-c", f"import sys, valiant; print('{module}' in sys.modules)"
+            ).stdout.strip()
+            == "False"
+        )
@@ -0,0 +1,83 @@
+from addict import Dict
+from parametrized import parametrized
+from pytest import fixture, mark
+from valiant.layered import Layered
+from valiant.miscellaneous import update, updateWithStrings
+
+
+@mark.layered
+class TestLayered:
+    @fixture
+    def base(self):
+        return dict(
+            dirs=["./."],
+            tags={"a"},
+            text="a",
+            number=0,
+            tangle=dict(enable=True, files=["a.org"]),
+        )
+
+    @fixture
+    def project(self):
+        return dict(
+            dirs=["../b"],
+            tags={"b"},
+            text="b",
+            number=1,
+            tangle=dict(files=["b.org"]),
+            test=dict(program="pytest"),
+        )
+
+    @parametrized.zip
+    def test_update(
+        self, base, project, delimiter=(None, "\n"), func=(update, updateWithStrings)
+    ):
+        assert Layered(base, project, delimiter=delimiter) == func(base, project)
+
+    def test_override(self):
+        assert Layered(dict(a=dict(b=0)), dict(a=1), dict(c=(0,))) == dict(a=1, c=(0,))
+        assert Layered(dict(a=1), dict(a=dict(b=0))).a.b == 0
+
+    def test_writes(self, base, project):
+        layered = Layered(base, project)
+        layered.tangle.enable = False
+        layered.dirs.append("../c")
+        layered.number = 2
+        assert layered.tangle.enable is False
+        assert layered.dirs == ["./.", "../b", "../c"]
+        assert layered.number == 2
+        assert base["tangle"]["enable"] is True
+        assert base["dirs"] == ["./."] and project["dirs"] == ["../b"]
+
+    def test_single_layer(self, base, project):
+        layered = Layered(base, dict(tangle=dict(files=["b.org"])))
+        layered.dirs.append("../c")
+        layered.tags.add("c")
+        materialized = Layered(base).to_dict(Dict)
+        materialized.tangle.files.append("c.org")
+        assert layered.dirs == ["./.", "../c"] and layered.tags == {"a", "c"}
+        assert base["dirs"] == ["./."] and base["tags"] == {"a"}
+        assert base["tangle"]["files"] == ["a.org"]
+
+    def test_missing(self, base):
+        layered = Layered(base)
+        assert not layered.nix.config.replace
+        assert "nix" not in layered
+        layered.nix.config.replace = True
+        assert layered.nix.config.replace is True
+        assert layered.to_dict()["nix"] == dict(config=dict(replace=True))
+
+    def test_delete(self, base, project):
+        layered = Layered(base, project)
+        del layered.tangle
+        assert "tangle" not in layered
+        assert list(layered) == ["dirs", "tags", "text", "number", "test"]
+
+    def test_to_dict(self, base, project):
+        materialized = Layered(base, project).to_dict(Dict)
+        assert isinstance(materialized, Dict)
+        assert isinstance(materialized.tangle, Dict)
+        assert materialized == update(base, project)
+        assert (Layered(base).tangle | dict(enable=False)) == dict(
+            enable=False, files=["a.org"]
+        )
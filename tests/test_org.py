@@ -0,0 +1,78 @@
+from pytest import fixture, mark
+from valiant.manifest import Manifest
+from valiant.org import exported, exportTargets, orgInputs, tangleTargets
+
+
+@mark.org
+class TestTangleTargets:
+    @fixture
+    def org(self, tmp_path):
+        return tmp_path / "README.org"
+
+    def test_targets(self, org, tmp_path):
+        org.write_text(
+            "\n".join(
+                (
+                    "#+property: header-args :tangle no",
+                    "#+begin_src python :tangle valiant.py",
+                    "#+end_src",
+                    '#+BEGIN_SRC nix :tangle "./nix/default.nix" :mkdirp yes',
+                    "#+END_SRC",
+                    "Some text with :tangle in it.",
+                )
+            )
+        )
+        assert tangleTargets(org) == {
+            tmp_path / "valiant.py",
+            tmp_path / "nix" / "default.nix",
+        }
+
+    def test_opaque(self, org):
+        org.write_text('#+begin_src python :tangle (concat "a" ".py")\n#+end_src')
+        assert tangleTargets(org) is None
+
+
+@mark.org
+def test_orgInputs(tmp_path):
+    (tmp_path / "index.org").write_text(
+        '#+INCLUDE: "./a.org::*Heading" :lines "1-5"\n#+setupfile: https://example.com/setup.org'
+    )
+    (tmp_path / "a.org").write_text("#+SETUPFILE: setup/b.org\n#+INCLUDE: index.org")
+    assert orgInputs(tmp_path / "index.org") == {
+        tmp_path / "a.org",
+        tmp_path / "index.org",
+        tmp_path / "setup" / "b.org",
+    }
+
+
+@mark.org
+def test_exportTargets(tmp_path):
+    (tmp_path / "index.org").write_text(
+        '#+title: Index\n#+EXPORT_FILE_NAME: "docs/index.md"\n#+export_file_name: README'
+    )
+    targets = exportTargets(tmp_path / "index.org")
+    assert targets == {tmp_path / "docs" / "index.md", tmp_path / "README"}
+    assert not any(map(exported, targets))
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "index.md").touch()
+    (tmp_path / "README.md").touch()
+    assert all(map(exported, targets))
+
+
+@mark.manifest
+class TestManifest:
+    def test_roundtrip(self, tmp_path):
+        manifest = Manifest("test", tmp_path / "project", directory=tmp_path)
+        manifest[tmp_path / "a"] = dict(hash="0")
+        manifest.save()
+        assert Manifest("test", tmp_path / "project", directory=tmp_path)[
+            tmp_path / "a"
+        ] == dict(hash="0")
+
+    def test_unwritable(self, tmp_path):
+        directory = tmp_path / "file"
+        directory.touch()
+        manifest = Manifest("test", "project", directory=directory)
+        manifest["a"] = 0
+        manifest.save()
+        assert manifest.modified
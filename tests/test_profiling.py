@@ -0,0 +1,55 @@
+import orjson as json
+
+from pytest import mark, raises
+from valiant.profiling import Profiler, profiler
+from valiant.sh import SH
+
+
+@mark.profiling
+class TestProfiler:
+    def test_disabled(self):
+        p = Profiler()
+        with p.span("phase"):
+            pass
+        assert p.subprocess(lambda: 0) == 0
+        assert not p.events
+
+    def test_spans(self, tmp_path):
+        p = Profiler()
+        with p.session(tmp_path / "profile"):
+            for project in ("a", "b"):
+                with p.span("tangle", project=project):
+                    sum(range(10000))
+            with p.span("test", "command"):
+                pass
+        summary = json.loads((tmp_path / "profile.json").read_bytes())
+        assert summary["phases"]["tangle"]["count"] == 2
+        assert set(summary["projects"]) == {"a", "b"}
+        assert summary["projects"]["a"]["phases"]["tangle"]["cpu"] >= 0
+        assert summary["commands"]["test"]["count"] == 1
+        trace = json.loads((tmp_path / "profile.trace.json").read_bytes())
+        complete = [e for e in trace["traceEvents"] if e["ph"] == "X"]
+        assert [e["name"] for e in complete] == ["tangle", "tangle", "test"]
+        assert any(e["ph"] == "M" for e in trace["traceEvents"])
+
+    def test_subprocesses(self, tmp_path):
+        with profiler.session(tmp_path / "profile"):
+            SH.echo("with spaces")
+            with raises(SH.ErrorReturnCode):
+                SH.false()
+        subprocesses = json.loads((tmp_path / "profile.json").read_bytes())[
+            "subprocesses"
+        ]
+        assert [(s["argv"][1:], s["exit_code"]) for s in subprocesses] == [
+            (["with spaces"], 0),
+            ([], 1),
+        ]
+        assert subprocesses[0]["argv"][0].endswith("echo")
+
+    def test_option(self):
+        from valiant import main
+
+        ctx = main.make_context("valiant", ["--profile", "build"])
+        assert ctx.params["profile"] is True
+        assert ctx.params["profile_prefix"] == "valiant-profile"
+        assert "build" not in ctx.params.values()
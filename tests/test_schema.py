@@ -0,0 +1,65 @@
+from addict import Dict
+from pytest import mark
+from valiant.layered import Layered
+from valiant.schema import GauntletOptions, Options, schema
+
+
+@mark.schema
+class TestSchema:
+    def test_defaults(self):
+        opts = GauntletOptions()
+        assert opts.tangle.enable is True
+        assert opts["update"].ignore == []
+        assert opts.nix_test.cmd is None
+        assert opts.nix.config.opts == dict()
+        assert not opts.nix_test
+        assert opts.test
+
+    def test_no_allocation(self):
+        opts = GauntletOptions(dict(test=dict(program="pytest")))
+        before = opts.to_dict()
+        assert opts.nix_test.cmd is None
+        assert opts.deps.shell is None
+        assert opts.to_dict() == before
+
+    def test_values(self):
+        opts = GauntletOptions(
+            Layered(
+                dict(dirs=["./."], test=dict(args=["-q"])),
+                dict(
+                    dirs=["../b"],
+                    test=dict(args=["-x"], deps=dict(a=1)),
+                    valiant=True,
+                ),
+            )
+        )
+        assert opts.dirs == ["./.", "../b"]
+        assert opts.test.args == ["-q", "-x"]
+        assert isinstance(opts.test.deps, Dict)
+        assert opts.test.deps.to_dict() == dict(a=1)
+        assert opts.valiant is True
+
+    def test_unknown(self):
+        opts = GauntletOptions(dict(extra=dict(nested=1)))
+        assert opts.extra.nested == 1
+        assert "extra" in opts
+        assert not opts.missing.nested
+        opts.added = dict(a=1)
+        assert opts["added"].a == 1
+        assert dict(opts.items())["added"] == dict(a=1)
+
+    def test_writes(self):
+        opts = GauntletOptions()
+        opts.tangle = dict(enable=False)
+        assert opts.tangle.enable is False
+        assert opts.tangle.tangle_files == []
+        opts.format = dict(py=dict(ignore=["a.py"]))
+        assert opts.format.py.ignore == ["a.py"]
+        del opts.tangle
+        assert opts.tangle.enable is True
+
+    def test_schema(self):
+        Section = schema("Section", a=1, b=list)
+        assert issubclass(Section, Options)
+        assert Section.__slots__ == ("a", "b")
+        assert Section(dict(b=[0])) == dict(a=1, b=[0])
@@ -1,11 +1,5 @@
 #!/usr/bin/env python3
 
-import black
-
-import rich.traceback as RichTraceback
-
-excepthook = RichTraceback.install(show_locals=True)
-
 try:
     import rich_click as click
 except ImportError:
@@ -18,26 +12,32 @@ import tomllib
 from addict import Dict
 from colors import strip_color
 from ast import literal_eval
-from functools import wraps
+from functools import partial, wraps
 from itertools import chain
 from os import environ
 from pathlib import Path
-from poetry2setup import build_setup_py
 from rich.pretty import pprint
 from rich.table import Table
 from tempfile import TemporaryDirectory
 
 from valiant.confirm import Confirm
-from valiant.gauntlet import Gauntlet as _Gauntlet
+from valiant.gauntlet import Gauntlet as _Gauntlet, gauntletPhases
+from valiant.layered import Layered
 from valiant.miscellaneous import *
 from valiant.miscellaneous import dirs as mdirs
 from valiant.opts import Opts
 from valiant.path import SuperPath as SP
+from valiant.profiling import profiler
 from valiant.shell import Shell as _Shell, QuickShell as _QuickShell
+from valiant.workspace import Workspace, collectDirs
 
 from valiant.sh import SH
 from sh import ErrorReturnCode, CommandNotFound
 
+# NOTE: `rich.traceback' is only installed once a command actually runs;
+#       see `main'.
+excepthook = sys.excepthook
+
 
 @click.group(
     invoke_without_command=True,
@@ -47,11 +47,26 @@ from sh import ErrorReturnCode, CommandNotFound
 @click.option("--dependencies/--skip-dependencies", default=True)
 @click.option("--do-not-prompt", is_flag=True)
 @click.option("--export/--skip-export", default=True)
+@click.option(
+    "--jobs",
+    type=click.IntRange(min=1),
+    help="Maximum number of directories to discover at once.",
+)
 @click.option("--just-export", is_flag=True)
 @click.option("--just-tangle", is_flag=True)
 @click.option("--just-test", is_flag=True)
 @click.option("--just-update", is_flag=True)
 @click.option("--offline", is_flag=True)
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Write a timing summary to PREFIX.json, and a Chrome trace to PREFIX.trace.json.",
+)
+@click.option(
+    "--profile-prefix",
+    default="valiant-profile",
+    help="Prefix of the files written with `--profile'.",
+)
 @click.option("--refresh", is_flag=True)
 @click.option("--setup/--skip-setup", default=True)
 @click.option("--tangle/--skip-tangle", default=True)
@@ -128,6 +143,7 @@ def main(
     global_pre,
     ignore_input,
     inputs,
+    jobs,
     just_export,
     just_tangle,
     just_test,
@@ -137,6 +153,8 @@ def main(
     offline,
     opts_dir,
     opts_file,
+    profile,
+    profile_prefix,
     refresh,
     remove,
     replace_nix_config,
@@ -155,6 +173,15 @@ def main(
     ):
         pass
     else:
+        import rich.traceback as RichTraceback
+
+        RichTraceback.install(show_locals=True)
+
+        if profile:
+            ctx.with_resource(
+                profiler.session(profile_prefix, log=partial(log, verbose=True))
+            )
+
         ctx.obj.do_not_prompt = do_not_prompt
         ctx.obj.do_not_prompt_dependencies = do_not_prompt_dependencies
 
@@ -240,7 +267,7 @@ def main(
                             table.add_row(k, str(v))
                         printPadded(table)
 
-        valiantOpts = Opts(name="valiant", sh=sh)
+        valiantOpts = Opts(name="valiant", sh=sh, refresh=refresh)
 
         class SuperPath(SP):
             def _print_in(self):
@@ -259,10 +286,14 @@ def main(
 
         class Gauntlet(_Gauntlet):
             def __init__(self, *args, **kwargs):
-                super().__init__(*args, sh=sh, optsParser=valiantOpts, **kwargs)
-                self.shell = Shell(self)
-                self.pureshell = Shell(self, pure=True)
-                self.quickshell = QuickShell(self)
+                with profiler.span("initialize", project=str(kwargs["directory"])):
+                    super().__init__(*args, sh=sh, optsParser=valiantOpts, **kwargs)
+
+            def mkShell(self, pure=False):
+                return Shell(self, pure=pure)
+
+            def mkQuickShell(self):
+                return QuickShell(self)
 
             def log(self, *args, **kwargs):
                 return log(*args, verbose=verbose, **kwargs)
@@ -337,16 +368,20 @@ def main(
         )
         ctx.obj.ignored_inputs = ignore_input
         ctx.obj.dependencies = dependency
+        ctx.obj.phases = (
+            getattr(
+                main.get_command(ctx, ctx.invoked_subcommand).callback,
+                "phases",
+                gauntletPhases,
+            )
+            if ctx.invoked_subcommand
+            else gauntletPhases
+        )
 
-        currentSystemKwargs = dict(impure=True, raw=True, expr="builtins.currentSystem")
-        currentSystem = sh.nix.eval(**currentSystemKwargs)
+        with profiler.span("currentSystem"):
+            ctx.obj.currentSystem = getCurrentSystem(sh=sh)
         console.print()
-        while not currentSystem:
-            warn("Sorry! Couldn't get the current system; trying again...")
-            currentSystem = sh.nix.eval(**currentSystemKwargs)
-        else:
-            log("Current system:", currentSystem)
-            ctx.obj.currentSystem = currentSystem
+        log("Current system:", ctx.obj.currentSystem)
 
         configure(_config=nix_config, **{opt[0]: opt[1] for opt in nix_opts})
         if replace_nix_config or replace_nix_opts:
@@ -367,6 +402,8 @@ def main(
             global_post=global_post,
             global_pre=global_pre,
             ignored_inputs=ctx.obj.ignored_inputs,
+            phases=ctx.obj.phases,
+            refresh=refresh,
             skip_export=ctx.obj.skip_export,
             skip_tangle=ctx.obj.skip_tangle,
             skip_tests=ctx.obj.skip_tests,
@@ -376,9 +413,10 @@ def main(
 
         ctx.obj.gauntlets = dict()
         ctx.obj.dirs = dict()
-        dauntlets = {
-            d: collectDirs(
-                {d: None},
+        dauntlets = dict()
+        with profiler.span("workspace"):
+            ctx.obj.workspace = Workspace(
+                map(SuperPath, chain(dirs, ctx.obj.opts.dirs)),
                 all_formats=all_formats,
                 dependencies=ctx.obj.dependencies,
                 formats=format,
@@ -386,14 +424,17 @@ def main(
                 sh=sh,
                 log=log,
                 optsParser=valiantOpts,
+                refresh=refresh,
+                jobs=jobs,
             )
-            for d in map(SuperPath, chain(dirs, ctx.obj.opts.dirs))
-        }
+        for d in ctx.obj.workspace.roots:
+            with profiler.span("collectDirs", project=str(d)):
+                dauntlets[d] = ctx.obj.workspace.collect(d)
         for k, v in dauntlets.items():
             gauntlets = {
                 d: Gauntlet(
                     directory=d,
-                    opts=update(ctx.obj.opts, g.opts),
+                    opts=Layered(ctx.obj.opts, g.opts),
                     command_pre=command_pre if d in ctx.obj.dirs else tuple(),
                     command_post=command_post if d in ctx.obj.dirs else tuple(),
                     **gKwargs,
@@ -410,6 +451,24 @@ def main(
             ctx.obj.gauntlets |= gauntlets
         ctx.obj.gauntlets = tuple(ctx.obj.gauntlets.values())
 
+        # NOTE: Without a subcommand, nothing else reads the gauntlets,
+        #       so their phases are run here.
+        if ctx.invoked_subcommand:
+            ctx.with_resource(profiler.span(ctx.invoked_subcommand, "command"))
+        else:
+            for g in ctx.obj.gauntlets:
+                g.ensure()
+
+
+# NOTE: Declares the gauntlet phases a subcommand needs;
+#       subcommands without a declaration need all of them.
+def requiredPhases(*phases):
+    def decorator(func):
+        func.phases = phases
+        return func
+
+    return decorator
+
 
 # Adapted from: https://github.com/pallets/click/issues/108#issuecomment-280489786
 def gauntletParams(func):
@@ -609,6 +668,7 @@ def _update(ctx, _gauntlet, inputs, all_inputs, ignore):
 
 
 @main.command()
+@requiredPhases("flake")
 @gauntletParams
 @click.argument("devshell", required=False)
 @click.option("--pure/--impure", default=True)
@@ -684,6 +744,7 @@ def pkgParams(func):
 
 
 @main.command(name="shell")
+@requiredPhases("flake")
 @gauntletParams
 @pkgParams
 @click.argument("command")
@@ -744,6 +805,7 @@ def _shell(ctx, _gauntlet, pkgs, pkg_string, with_pkgs, pure, command):
 
 
 @main.command()
+@requiredPhases("flake")
 @gauntletParams
 @click.option("--pure/--impure", default=True)
 @click.option("-r", "--repl", "_repl")
@@ -867,6 +929,7 @@ def repl(ctx, _gauntlet, pure, _repl):
 
 
 @main.command(name="nix-repl")
+@requiredPhases("flake")
 @gauntletParams
 @click.option("--pure/--impure", default=True)
 @click.pass_context
@@ -892,6 +955,7 @@ def nix_repl(ctx, _gauntlet, pure):
 
 
 @main.command()
+@requiredPhases()
 @gauntletParams
 @click.argument("pkgs", nargs=-1, required=False, type=click.UNPROCESSED)
 @click.option("-d", "--dry-run", is_flag=True)
@@ -918,6 +982,7 @@ def build(ctx, _gauntlet, pkgs, dry_run):
 
 
 @main.command(context_settings=dict(ignore_unknown_options=True), name="nix")
+@requiredPhases()
 @gauntletParams
 @click.argument("args", nargs=-1, type=click.UNPROCESSED)
 @click.pass_context
@@ -935,6 +1000,7 @@ def _nix(ctx, _gauntlet, args):
 
 
 @main.command(context_settings=dict(ignore_unknown_options=True), name="nix-shell")
+@requiredPhases()
 @gauntletParams
 @click.argument("args", nargs=-1, type=click.UNPROCESSED)
 @click.pass_context
@@ -966,6 +1032,7 @@ def _nix_shell(ctx, _gauntlet, args):
 
 
 @main.command(context_settings=dict(ignore_unknown_options=True), name="nix-run")
+@requiredPhases()
 @gauntletParams
 @click.option("-p", "--pkg", default="default")
 @click.argument("args", nargs=-1, type=click.UNPROCESSED)
@@ -1004,6 +1071,7 @@ def _nix_run(ctx, _gauntlet, pkg, args):
 
 
 @main.command()
+@requiredPhases()
 @gauntletParams
 @click.argument("command")
 @click.pass_context
@@ -1018,6 +1086,7 @@ def cmd(ctx, command, _gauntlet):
 
 
 @main.command(name="run", context_settings=dict(ignore_unknown_options=True))
+@requiredPhases()
 @gauntletParams
 @click.argument("args", nargs=-1, required=False, type=click.UNPROCESSED)
 @click.option("-p", "--pkg", default="default")
@@ -1038,6 +1107,7 @@ def _run(ctx, args, _gauntlet, pkg):
 
 
 @main.command()
+@requiredPhases()
 @gauntletParams
 @click.option("-p", "--pkgs", multiple=True, default=("default",))
 @click.option("-P", "--priority")
@@ -1176,6 +1246,7 @@ def _remove(ctx, pkgs, _all):
 
 
 @main.command(name="touch-test")
+@requiredPhases("flake")
 @gauntletParams
 @click.option("--pure/--impure", default=True)
 @click.argument("test")
@@ -1262,6 +1333,7 @@ def _super(
 
 
 @main.command()
+@requiredPhases("tangle")
 @gauntletParams
 @click.pass_context
 def poetry2setup(ctx, _gauntlet):
@@ -1269,6 +1341,10 @@ def poetry2setup(ctx, _gauntlet):
         pyproject = g.dir / "pyproject.toml"
         if pyproject.exists():
             if Dict(tomllib.loads(pyproject.read_text())).tool.poetry:
+                import black
+
+                from poetry2setup import build_setup_py
+
                 with g.process():
                     log(f"Converting {g.dir}/pyproject.toml to {g.dir}/setup.py...")
                     (g.dir / "setup.py").write_text(
@@ -1284,6 +1360,7 @@ def poetry2setup(ctx, _gauntlet):
 
 
 @main.command(name="touch-tests")
+@requiredPhases("tangle")
 @gauntletParams
 @click.pass_context
 def touch_tests(ctx, _gauntlet):
@@ -1303,6 +1380,7 @@ def touch_tests(ctx, _gauntlet):
 
 
 @main.command(name="test", context_settings=dict(ignore_unknown_options=True))
+@requiredPhases("tangle", "flake")
 @gauntletParams
 @click.argument("args", nargs=-1, required=False, type=click.UNPROCESSED)
 @click.option("-f", "--file", multiple=True)
@@ -1356,6 +1434,7 @@ def _test(ctx, args, _gauntlet, file, dirs):
 
 
 @main.command(name="nix-test", context_settings=dict(ignore_unknown_options=True))
+@requiredPhases("tangle", "flake")
 @gauntletParams
 @click.argument("args", nargs=-1, required=False, type=click.UNPROCESSED)
 @click.option("-f", "--file", multiple=True)
@@ -1406,6 +1485,7 @@ def nix_test(ctx, args, pkg, _gauntlet, file, dirs):
 
 
 @main.command(name="super-test", context_settings=dict(ignore_unknown_options=True))
+@requiredPhases("tangle", "flake")
 @gauntletParams
 @click.argument("args", nargs=-1, required=False, type=click.UNPROCESSED)
 @click.option("-f", "--file", multiple=True)
@@ -1424,6 +1504,7 @@ def super_test(ctx, file, dirs, pkg, args, _gauntlet):
 
 
 @main.command(name="test-native", context_settings=dict(ignore_unknown_options=True))
+@requiredPhases("tangle", "flake")
 @gauntletParams
 @click.option("-f", "--file", multiple=True)
 @click.argument(
@@ -1442,6 +1523,7 @@ def test_native(ctx, args, _gauntlet, file):
 
 
 @main.command(context_settings=dict(ignore_unknown_options=True))
+@requiredPhases()
 @gauntletParams
 @click.option("--subcommand", "_subcommand", hidden=True)
 @click.argument("args", nargs=-1, required=False, type=click.UNPROCESSED)
@@ -1565,6 +1647,7 @@ def deps(
 
 
 @main.command(name="test-click", hidden=True)
+@requiredPhases()
 @click.pass_context
 def test_click(ctx):
     g = next(iter(ctx.obj.gauntlets))
@@ -0,0 +1,89 @@
+import os
+
+from dataclasses import replace
+from pathlib import Path
+from time import perf_counter
+
+from .miscellaneous import write_atomic
+
+
+# NOTE: Mirrors the options the `black' executable reads from a project's `pyproject.toml'.
+def blackMode(directory):
+    import black
+
+    config = dict()
+    if pyproject := black.find_pyproject_toml((str(directory),)):
+        config = black.parse_pyproject_toml(pyproject)
+    return black.Mode(
+        line_length=config.get("line_length", black.DEFAULT_LINE_LENGTH),
+        string_normalization=not config.get("skip_string_normalization", False),
+        magic_trailing_comma=not config.get("skip_magic_trailing_comma", False),
+        preview=config.get("preview", False),
+        target_versions={
+            black.TargetVersion[version.upper()]
+            for version in config.get("target_version", tuple())
+        },
+    )
+
+
+# NOTE: Returns the file, whether it was "unchanged", "reformatted", or "failed",
+#       and how long it took.
+def formatPythonFile(file, mode):
+    import black
+
+    start = perf_counter()
+    path = Path(file)
+    try:
+        contents, encoding, newline = black.decode_bytes(path.read_bytes())
+        formatted = black.format_file_contents(
+            contents,
+            fast=False,
+            mode=replace(mode, is_pyi=path.suffix == ".pyi"),
+        )
+    except black.NothingChanged:
+        status = "unchanged"
+    except Exception:
+        status = "failed"
+    else:
+        write_atomic(path, formatted.replace("\n", newline).encode(encoding))
+        status = "reformatted"
+    return file, status, perf_counter() - start
+
+
+# NOTE: Below this many files, starting workers that import `black' again
+#       costs more than formatting the files here.
+poolThreshold = 32
+
+
+# NOTE: Keeps the exit code of the `black' executable;
+#       0 if every file was handled, and 123 if any of them couldn't be formatted.
+def formatPython(files, directory, workers=None, threshold=poolThreshold):
+    files = tuple(files)
+    mode = blackMode(directory)
+    workers = min(workers or os.cpu_count() or 1, len(files))
+    if (workers > 1) and (len(files) >= threshold):
+        import multiprocessing
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        # NOTE: This runs in a gauntlet stage's thread, and forking a threaded process
+        #       may copy locks held by other threads; workers are started clean instead.
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context(
+                "forkserver"
+                if "forkserver" in multiprocessing.get_all_start_methods()
+                else "spawn"
+            ),
+        ) as executor:
+            results = tuple(
+                executor.map(
+                    formatPythonFile,
+                    files,
+                    (mode,) * len(files),
+                    chunksize=max(1, len(files) // (workers * 4)),
+                )
+            )
+    else:
+        results = tuple(formatPythonFile(file, mode) for file in files)
+    return (123 if any(status == "failed" for _, status, _ in results) else 0), results
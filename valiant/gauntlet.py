@@ -1,29 +1,67 @@
-import black
 import orjson as json
+import re
 
 from addict import Dict
 from autoslot import Slots
+from concurrent.futures import ThreadPoolExecutor, wait
 from contextlib import contextmanager
+from fnmatch import fnmatch
+from functools import partial
 from itertools import chain
 from more_itertools import intersperse
-from os import chdir
+from os import chdir, walk
+from os.path import join
 from pathlib import Path
+from string import Formatter
 from rich.console import Console
 from rich.table import Table
 from sh import ErrorReturnCode
 
+from .formatter import formatPython
+from .manifest import Manifest
 from .miscellaneous import *
-from .path import SuperPath
+from .org import exported, exportTargets, orgInputs, tangleTargets
+from .path import SuperPath, xxh
+from .profiling import profiler
+from .schema import GauntletOptions
 from .sh import SH
 from .shell import QuickShell, Shell
 
 
+# NOTE: Pruned while walking a project for files to format.
+formatPruned = {".git", "directory_templates", "dt"}
+
+# NOTE: Ordered; ensuring a phase also runs every earlier phase the gauntlet requires.
+gauntletPhases = ("tangle", "update", "flake", "format", "export")
+
+# NOTE: Background stages that write formatted files;
+#       anything reading them has to wait for these first.
+formatStages = ("nix", "py")
+
+# NOTE: Properties that run phases, build shells, or call out to git or nix when read;
+#       only passed to commands that refer to them.
+lazyAttributes = (
+    "doCheck",
+    "flake",
+    "group",
+    "inputs",
+    "modified",
+    "projectName",
+    "pureshell",
+    "quickshell",
+    "shell",
+    "testFiles",
+    "type",
+)
+
+
 class Gauntlet(Slots):
     def __init__(
         self,
         directory,
         *,
         all_inputs=False,
+        cache=local,
         command_post=tuple(),
         command_pre=tuple(),
         currentSystem="x86_64-linux",
@@ -37,6 +75,8 @@ class Gauntlet(Slots):
         ignored_inputs=tuple(),
         opts=None,
         optsParser=None,
+        phases=gauntletPhases,
+        refresh=False,
         remove=tuple(),
         sh=SH,
         skip_export=False,
@@ -73,6 +113,7 @@ class Gauntlet(Slots):
                 for k, v in self.opts.format.items()
             }
         )
+        self.opts = GauntletOptions(self.opts)
 
         self.verbose = verbose or self.opts.verbose or 0
 
@@ -109,6 +150,39 @@ class Gauntlet(Slots):
         self.force_with_lease = force_with_lease
         self.global_pre_post_run = False
 
+        self.refresh = refresh
+        self.cacheDirectory = cache
+        self.tangleManifest = Manifest("tangle", self.dir, cache)
+        self.exportManifest = Manifest("export", self.dir, cache)
+        self.formatManifest = Manifest("format", self.dir, cache)
+        self.formatted = set()
+
+        # NOTE: Phases only run when something first reads their results;
+        #       see `ensure'.
+        self.phases = tuple(p for p in gauntletPhases if p in phases)
+        self.completed_phases = set()
+        self.running_phases = set()
+        self.cache = dict()
+
+        # NOTE: Files to tangle are queued across phases,
+        #       and flushed in a single `org-tangle' call when something needs them.
+        self.tangleQueue = dict()
+
+        # NOTE: Independent steps run as background stages;
+        #       see `stage' and `barrier'.
+        self.stages = dict()
+        self.executor = None
+
+        self.default_flake = Dict(
+            pname=self.dir.name,
+            type="general",
+            group="general",
+            doCheck=False,
+            testFiles=None,
+        )
+        self._flake = self.default_flake if self.no_flake else flake
+        self._ensured = Dict()
+
         if self.skip_tangle:
             self.pre_tangle_files = self.tangle_files = tuple()
         else:
@@ -128,35 +202,119 @@ class Gauntlet(Slots):
                     )
                 )
             )
-            self.tangle(self.pre_tangle_files)
+            self.tangle_files = set(self.pre_tangle_files)
 
+        if self.skip_export:
+            self.export_files = tuple()
+        else:
+            # NOTE: Some files here may depend on previous files during export.
+            # Adapted from:
+            # Answer: https://stackoverflow.com/a/17016257/10827766
+            # User: https://stackoverflow.com/users/1219006/jamylak
+            self.export_files = tuple(
+                dict.fromkeys(
+                    SuperPath(self.dir, file)
+                    for file in chain(
+                        ("index.org",),
+                        self.opts.export.export_files,
+                        export_files,
+                    )
+                )
+            )
+
+        if self.verbose > 2:
+            self.log("Gauntlet Initialized:\n", self)
+        else:
+            self.log(f"Gauntlet for {self.dir} initialized!")
+        console.print("\n")
+
+    def ensure(self, *names):
+        wanted = names or self.phases
+        if wanted:
+            last = max(map(gauntletPhases.index, wanted))
+            pending = [
+                phase
+                for phase in gauntletPhases[: last + 1]
+                if (phase in self.phases or phase in wanted)
+                and (phase not in self.completed_phases)
+                and (phase not in self.running_phases)
+            ]
+            for phase in pending:
+                # NOTE: Phases are only completed once they succeed,
+                #       so a failing phase fails again on the next read.
+                self.running_phases.add(phase)
+                try:
+                    with profiler.span(phase, project=self.sir):
+                        # NOTE: Formatting doesn't need the flake,
+                        #       so it runs while the flake is being evaluated.
+                        if (phase == "flake") and ("format" in pending):
+                            self.startFlake()
+                            self.startFormat()
+                        getattr(self, phase + "Phase")()
+                finally:
+                    self.running_phases.discard(phase)
+                self.completed_phases.add(phase)
+            if pending:
+                self.flushTangle()
+                self.barrier()
+
+    def stage(self, name, func, *args, after=tuple(), **kwargs):
+        if name not in self.stages:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(thread_name_prefix=self.dir.name)
+            dependencies = [self.stages[n] for n in after if n in self.stages]
+
+            def run():
+                wait(dependencies)
+                with profiler.span(name, "stage", project=self.sir):
+                    return func(*args, **kwargs)
+
+            self.stages[name] = self.executor.submit(run)
+        return self.stages[name]
+
+    def barrier(self, *names):
+        futures = [self.stages.pop(n, None) for n in (names or tuple(self.stages))]
+        wait(filter(None, futures))
+        return tuple(future and future.result() for future in futures)
+
+    # NOTE: Unlike `barrier', this leaves the stages in place,
+    #       so whatever collects them later still gets their results.
+    def waitFor(self, *names):
+        wait(filter(None, map(self.stages.get, names or tuple(self.stages))))
+
+    def tanglePhase(self):
+        if not self.skip_tangle:
+            self.queueTangle(self.pre_tangle_files)
+
+    @staticmethod
+    def nixTarget(target):
+        return (target.suffix == ".nix") or (target.name == "flake.lock")
+
+    def updatePhase(self):
         if not (self.skip_update or self.no_flake):
-            if (lockfile := self.dir / "flake.lock").exists():
-                self.inputs = Dict(
-                    json.loads(lockfile.read_text())
-                ).nodes.root.inputs.keys()
+            self.flushTangle(self.nixTarget)
+            if (self.dir / "flake.lock").exists():
                 self.update()
             else:
                 self.update(all_inputs=True)
-                self.inputs = Dict(
-                    json.loads(lockfile.read_text())
-                ).nodes.root.inputs.keys()
 
-        self.default_flake = Dict(
-            pname=self.dir.name,
-            type="general",
-            group="general",
-            doCheck=False,
-            testFiles=None,
-        )
-        if self.no_flake:
-            self.flake = self.default_flake
-        else:
-            self.flake = flake or getFlake(
+    def startFlake(self):
+        if self._flake is None:
+            self.flushTangle(self.nixTarget)
+            self.stage(
+                "getFlake",
+                getFlake,
                 sh=self.sh,
                 directory=self.dir,
+                cache=self.cacheDirectory,
+                refresh=self.refresh,
             )
 
+    def flakePhase(self):
+        if self._flake is None:
+            self.startFlake()
+            (self._flake,) = self.barrier("getFlake")
+
         table = Table(title=f"[{style}]Ensured Variables", style=style)
         for column in ("Name", "Value"):
             table.add_column(column, justify="center")
@@ -164,22 +322,18 @@ class Gauntlet(Slots):
         self.log("Setting ensured variables...")
 
         if self.skip_tests:
-            self.projectName = self.default_flake.pname
+            self._ensured.projectName = self.default_flake.pname
             for attr in ("type", "doCheck", "group", "testFiles"):
-                setattr(self, attr, self.default_flake[attr])
+                self._ensured[attr] = self.default_flake[attr]
         else:
-            self.projectName = self.flake.pname
-            self.type = self.flake.type
-            self.group = self.flake.group
-            self.doCheck = self.flake.doCheck
-            self.testFiles = self.flake.testFiles or (
+            self._ensured.projectName = self._flake.pname
+            self._ensured.type = self._flake.type
+            self._ensured.group = self._flake.group
+            self._ensured.doCheck = self._flake.doCheck
+            self._ensured.testFiles = self._flake.testFiles or (
                 (self.projectName,) if self.group == "emacs" else None
             )
 
-        self.shell = Shell(self)
-        self.pureshell = Shell(self, pure=True)
-        self.quickshell = QuickShell(self)
-
         variables = {
             "projectName": "Project Name",
             "type": "Type",
@@ -188,7 +342,7 @@ class Gauntlet(Slots):
             "doCheck": "Do Check",
         }
         for k, v in variables.items():
-            table.add_row(v, str(getattr(self, k)))
+            table.add_row(v, str(self._ensured[k]))
 
         console.print()
         printPadded(table)
@@ -200,62 +354,178 @@ class Gauntlet(Slots):
         else:
             console.print()
 
-        if not self.skip_tangle:
+        if ("tangle" in self.phases) and not self.skip_tangle:
             additional_tangle_files = [
                 SuperPath(self.dir, file) for file in (self.projectName,)
             ]
-            self.tangle_files = set(
-                chain(
-                    self.pre_tangle_files,
-                    additional_tangle_files,
-                )
-            )
-            self.tangle(additional_tangle_files)
+            self.tangle_files |= set(additional_tangle_files)
+            self.queueTangle(additional_tangle_files)
 
-        self.sh.nixfmt(*self.excluded_parts("nix"), quiet=True, _ok_code=(0, 1))
-        self.sh.black(*self.excluded_parts("py"), quiet=True, _ok_code=(0, 1, 123))
+    # NOTE: Every formatter waits for the flake evaluation,
+    #       since that copies the same source tree they rewrite.
+    def startFormat(self):
+        self.flushTangle()
+        for ext in formatStages:
+            if (ext not in self.stages) and (files := self.changed_parts(ext)):
+                self.stage(ext, self.formatParts, ext, files, after=("getFlake",))
 
-        if self.skip_export:
-            self.export_files = tuple()
+    # NOTE: The flake phase may have tangled more files while formatting,
+    #       so this repeats until nothing is left to format.
+    def formatPhase(self):
+        self.startFormat()
+        while self.settleFormat():
+            self.startFormat()
+        self.rehashTangled()
+
+    # NOTE: Tangling rewrites the files being formatted,
+    #       so running format stages are finished and recorded first.
+    def settleFormat(self):
+        if results := list(filter(None, self.barrier(*formatStages))):
+            self.recordFormatted(chain.from_iterable(results))
+        return results
+
+    def formatParts(self, ext, files):
+        if ext == "nix":
+            self.sh.nixfmt(*files, quiet=True, _ok_code=(0, 1))
         else:
-            # NOTE: Some files here may depend on previous files during export.
-            # Adapted from:
-            # Answer: https://stackoverflow.com/a/17016257/10827766
-            # User: https://stackoverflow.com/users/1219006/jamylak
-            self.export_files = tuple(
-                dict.fromkeys(
-                    SuperPath(self.dir, file)
-                    for file in chain(
-                        ("index.org",),
-                        self.opts.export.export_files,
-                        export_files,
+            self.formatPython(files)
+        return files
+
+    def formatPython(self, files):
+        self.log(f"Now formatting python files from {self.dir}...")
+        code, results = formatPython(files, self.dir)
+        self.log_list(
+            (
+                f"{file}: {status} in {seconds:.3f}s"
+                for file, status, seconds in results
+            ),
+            "Formatted",
+            f"python files from {self.dir}",
+            sentence_end=".",
+        )
+        if code:
+            warn(
+                f"Some python files from {self.dir} could not be formatted"
+                + (
+                    self.log_list_format(
+                        file for file, status, _ in results if status == "failed"
                     )
+                    if self.verbose > 2
+                    else "."
                 )
             )
-            self.export(self.export_files)
+        return code
 
-        if self.verbose > 2:
-            self.log("Gauntlet Initialized:\n", self)
-        else:
-            self.log(f"Gauntlet for {self.dir} initialized!")
-        console.print("\n")
+    def exportPhase(self):
+        if not self.skip_export:
+            self.barrier()
+            self.flushTangle()
+            self.export(self.export_files, flush=False)
+
+    def cached(self, name, func):
+        if name not in self.cache:
+            self.cache[name] = func()
+        return self.cache[name]
+
+    @property
+    def flake(self):
+        self.ensure("flake")
+        return self._flake
+
+    @property
+    def projectName(self):
+        self.ensure("flake")
+        return self._ensured.projectName
+
+    @property
+    def type(self):
+        self.ensure("flake")
+        return self._ensured.type
+
+    @property
+    def group(self):
+        self.ensure("flake")
+        return self._ensured.group
+
+    @property
+    def doCheck(self):
+        self.ensure("flake")
+        return self._ensured.doCheck
+
+    @property
+    def testFiles(self):
+        self.ensure("flake")
+        return self._ensured.testFiles
+
+    @property
+    def inputs(self):
+        def inner():
+            lockfile = self.dir / "flake.lock"
+            if lockfile.exists():
+                return Dict(json.loads(lockfile.read_text())).nodes.root.inputs.keys()
+            return tuple()
+
+        return self.cached("inputs", inner)
+
+    def mkShell(self, pure=False):
+        return Shell(self, pure=pure)
+
+    def mkQuickShell(self):
+        return QuickShell(self)
+
+    @property
+    def shell(self):
+        return self.cached("shell", self.mkShell)
+
+    @property
+    def pureshell(self):
+        return self.cached("pureshell", partial(self.mkShell, pure=True))
+
+    @property
+    def quickshell(self):
+        return self.cached("quickshell", self.mkQuickShell)
 
     def excluded_parts(self, ext):
-        return (
-            str(file)
-            for file in self.dir.rglob("*." + ext)
-            if not (
-                any(
-                    p
-                    for p in (
-                        "directory_templates",
-                        "dt",
-                    )
-                    if p in file.parts
-                )
-                or file in self.opts.format[ext].ignore
-            )
-        )
+        ignore = set(map(str, self.opts.format[ext].ignore))
+        suffix = "." + ext
+        for root, directories, files in walk(self.dir):
+            directories[:] = (d for d in directories if d not in formatPruned)
+            for file in files:
+                if file.endswith(suffix) and ((path := join(root, file)) not in ignore):
+                    yield path
+
+    # NOTE: Files whose size and modification time changed are only stale
+    #       if their contents changed as well.
+    def formatStale(self, file):
+        if entry := self.formatManifest.get(file):
+            stat = Path(file).stat()
+            size, mtime, digest = entry
+            if (size, mtime) == (stat.st_size, stat.st_mtime_ns):
+                return False
+            if digest == xxh(Path(file).read_bytes()).hexdigest():
+                self.formatManifest[file] = [stat.st_size, stat.st_mtime_ns, digest]
+                return False
+        return True
+
+    def changed_parts(self, ext):
+        return [
+            file
+            for file in self.excluded_parts(ext)
+            if self.refresh or self.formatStale(file)
+        ]
+
+    # NOTE: Files the formatters couldn't handle are recorded as well,
+    #       so they're only retried once they change.
+    def recordFormatted(self, files):
+        for file in filter(Path.is_file, map(Path, files)):
+            self.formatted.add(str(SuperPath(file)))
+            stat = file.stat()
+            self.formatManifest[file] = [
+                stat.st_size,
+                stat.st_mtime_ns,
+                xxh(file.read_bytes()).hexdigest(),
+            ]
+        self.formatManifest.save()
 
     def log(self, *args, **kwargs):
         ...
@@ -263,9 +533,22 @@ class Gauntlet(Slots):
     def notify(self, *args, **kwargs):
         ...
 
-    def values(self):
+    def values(self, command=""):
         # return {item: getattr(self, item) for item in self.__slots__}
-        return dirs(self)
+        fields = {
+            re.split(r"[.\[]", field)[0]
+            for _, field, _, _ in Formatter().parse(command or "")
+            if field
+        }
+        dct = Dict()
+        for attr in dir(self):
+            if (attr in lazyAttributes) and (attr not in fields):
+                continue
+            try:
+                dct[attr] = getattr(self, attr)
+            except:
+                pass
+        return dct
 
     def __rich_repr__(self):
         for k, v in (
@@ -300,6 +583,8 @@ class Gauntlet(Slots):
                 return v
 
     def __repr__(self):
+        import black
+
         values = dict()
         for k, v in (
             {
@@ -379,6 +664,7 @@ class Gauntlet(Slots):
 
     @contextmanager
     def process(self, command=False):
+        self.ensure()
         with configuring(
             _replace=self.opts.nix.config.replace,
             _config=self.opts.nix.config.text,
@@ -399,7 +685,7 @@ class Gauntlet(Slots):
                                 )
                             ),
                         )
-                    self.sh._run(cmd, **self.values(), _fg=True)
+                    self.sh._run(cmd, **self.values(cmd), _fg=True)
 
             pre = self.command_pre if command else self.global_pre
             post = self.command_post if command else self.global_post
@@ -418,6 +704,7 @@ class Gauntlet(Slots):
                     runCmds(post)
 
     def add(self, fds=tuple()):
+        self.waitFor(*formatStages)
         if fds:
             self.log_list(
                 fds,
@@ -432,32 +719,192 @@ class Gauntlet(Slots):
         self.log_out("The", f"files from {self.dir} were added.")
 
     def removeTangleBackups(self):
-        for file in set(chain.from_iterable(map(self.dir.rglob, ("*.*~", "#*.org*")))):
-            file.unlink()
+        for file in self.dir.rglob("*"):
+            if any(map(partial(fnmatch, file.name), ("*.*~", "#*.org*"))) and (
+                file.is_file() or file.is_symlink()
+            ):
+                file.unlink()
 
-    def tangle(self, files, exporting=False):
+    # NOTE: Directories are stale when any of the org files in them are.
+    def tangleSources(self, files):
+        for file in map(SuperPath, files):
+            if file.is_dir():
+                yield from file.rglob("*.org")
+            elif file.is_file():
+                yield file
+
+    def tangleStale(self, file):
+        file = SuperPath(file)
+        if file.is_dir():
+            return any(map(self.tangleStale, self.tangleSources((file,))))
+        if not file.exists():
+            return False
+        entry = self.tangleManifest.get(file)
+        if not entry or entry["opaque"] or (entry["hash"] != file.xxhexdigest()):
+            return True
+        return any(
+            (digest is None)
+            or (not output.is_file())
+            or (output.xxhexdigest() != digest)
+            for output, digest in zip(
+                map(SuperPath, entry["outputs"].keys()), entry["outputs"].values()
+            )
+        )
+
+    def recordTangled(self, files):
+        for file in self.tangleSources(files):
+            targets = tangleTargets(file)
+            self.tangleManifest[file] = dict(
+                hash=file.xxhexdigest(),
+                opaque=targets is None,
+                outputs={
+                    str(target): target.xxhexdigest() if target.is_file() else None
+                    for target in targets or tuple()
+                },
+            )
+        self.tangleManifest.save()
+
+    # NOTE: Tangled outputs may be reformatted afterwards,
+    #       so the recorded hashes of those formatted since are refreshed.
+    def rehashTangled(self):
+        if not self.formatted:
+            return
+        for file, entry in tuple(self.tangleManifest.items()):
+            if touched := self.formatted.intersection(entry["outputs"]):
+                self.tangleManifest[file] = entry | dict(
+                    outputs=entry["outputs"]
+                    | {
+                        str(output): output.xxhexdigest() if output.is_file() else None
+                        for output in map(SuperPath, touched)
+                    }
+                )
+        self.formatted.clear()
+        self.tangleManifest.save()
+
+    def queueTangle(self, files, exporting=False):
+        for file in map(SuperPath, files):
+            self.tangleQueue[file] = self.tangleQueue.get(file, False) or exporting
+
+    # NOTE: With `needs', the queue is only flushed if a stale queued source
+    #       may tangle a target matching it.
+    def flushTangle(self, needs=None):
+        if not self.tangleQueue:
+            return
+        if needs and not any(
+            (targets is None) or any(map(needs, targets))
+            for targets in map(
+                tangleTargets,
+                filter(self.tangleStale, self.tangleSources(self.tangleQueue)),
+            )
+        ):
+            return
+        files = tuple(self.tangleQueue)
+        exporting = any(self.tangleQueue.values())
+        self.tangleQueue.clear()
         after_exporting = " after exporting" if exporting else ""
+        if not self.refresh:
+            files = tuple(filter(self.tangleStale, files))
+        if not files:
+            self.log(
+                f"Tangled files from {self.sir} are up to date{after_exporting}; skipping..."
+            )
+            return
         self.log_list(
             files,
             "Now tangling",
             "files and directories from " + self.sir + after_exporting,
         )
+        self.settleFormat()
         self.removeTangleBackups()
         self.org_tangle(*files)
+        self.recordTangled(files)
         self.add()
         self.log_out(
             "Tangled",
             "files from " + self.sir + after_exporting,
         )
 
+    def tangle(self, files, exporting=False):
+        self.queueTangle(files, exporting=exporting)
+        self.flushTangle()
+
     def tangleFiles(self, files=tuple()):
         self.tangle(chain(files, self.tangle_files))
 
-    def export(self, files):
+    def exportInputs(self, file):
+        return {file} | orgInputs(file)
+
+    # NOTE: Exports are stale when any of their inputs changed,
+    #       or when any of the files they were exported to is missing.
+    def exportStale(self, file, inputs):
+        entry = self.exportManifest.get(file)
+        if not entry or (set(entry["inputs"]) != set(map(str, inputs))):
+            return True
+        if not all(map(exported, entry.get("outputs", tuple()))):
+            return True
+        return any(
+            (digest is None)
+            or (not SuperPath(input).is_file())
+            or (SuperPath(input).xxhexdigest() != digest)
+            for input, digest in entry["inputs"].items()
+        )
+
+    # NOTE: Returns the stale export files, and every export file including them,
+    #       with the files they include ordered before them.
+    def planExport(self, files):
+        files = tuple(file for file in map(SuperPath, files) if file.is_file())
+        inputs = {file: self.exportInputs(file) for file in files}
+        stale = {
+            file
+            for file in files
+            if self.refresh or self.exportStale(file, inputs[file])
+        }
+        dependents = True
+        while dependents:
+            dependents = {
+                file for file in files if (file not in stale) and (inputs[file] & stale)
+            }
+            stale |= dependents
+
+        plan = []
+        visited = set()
+
+        def visit(file):
+            if file not in visited:
+                visited.add(file)
+                for dependency in files:
+                    if (dependency != file) and (dependency in inputs[file]):
+                        visit(dependency)
+                if file in stale:
+                    plan.append(file)
+
+        for file in files:
+            visit(file)
+        return plan
+
+    def recordExported(self, files):
+        for file in files:
+            self.exportManifest[file] = dict(
+                inputs={
+                    str(input): input.xxhexdigest() if input.is_file() else None
+                    for input in self.exportInputs(file)
+                },
+                outputs=sorted(map(str, exportTargets(file))),
+            )
+        self.exportManifest.save()
+
+    def export(self, files, flush=True):
+        files = self.planExport(files)
+        if not files:
+            self.log(f"Exported files from {self.dir} are up to date; skipping...")
+            return
         self.log_list(files, "Now exporting", "files from", self.dir)
         self.org_export(*files)
         self.log_out("Exported", "files from", self.sir + ".")
-        self.tangle(files, exporting=True)
+        self.queueTangle(files, exporting=True)
+        if flush:
+            self.flushTangle()
+        self.recordExported(files)
 
     def mkInputs(self, keys=tuple(), ignores=tuple()):
         return ["--update-input"] + list(
@@ -512,6 +959,10 @@ class Gauntlet(Slots):
             self.mkUpdateCommand(all_inputs=all_inputs, keys=keys, ignores=ignores)()
         except ErrorReturnCode:
             self.mkUpdateCommand(all_inputs=True)
+        self.cache.pop("inputs", None)
+        flakeCache = Manifest("flake", self.dir, self.cacheDirectory)
+        flakeCache.clear()
+        flakeCache.save()
         self.log_out("Updated", f"inputs from {self.dir}/flake.nix.")
 
     @property
@@ -527,7 +978,9 @@ class Gauntlet(Slots):
 
     def nix_test(self, pkg, *args, files=tuple(), return_expr=False):
         if self.opts.nix_test.cmd:
-            return self.sh._format(self.opts.nix_test.cmd, **self.values())
+            return self.sh._format(
+                self.opts.nix_test.cmd, **self.values(self.opts.nix_test.cmd)
+            )
         else:
             args = chain(args, self.opts.test.args)
             match self.group:
@@ -563,7 +1016,9 @@ class Gauntlet(Slots):
 
     def test(self, *args, files=tuple()):
         if self.opts.test.cmd:
-            return self.sh._format(self.opts.test.cmd, **self.values())
+            return self.sh._format(
+                self.opts.test.cmd, **self.values(self.opts.test.cmd)
+            )
         else:
             args = chain(args, self.opts.test.args)
             match self.group:
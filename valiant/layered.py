@@ -0,0 +1,121 @@
+from addict import Dict
+from collections.abc import Mapping, MutableMapping
+from itertools import chain
+
+
+# NOTE: A read-through view over option layers, from the lowest to the highest,
+#       merging them as `update' would: lists are appended, sets are unioned,
+#       strings are joined with `delimiter' when one is given,
+#       and everything else is taken from the highest layer.
+#       Nothing is copied until read, and writes only ever go to the view itself;
+#       lists and sets are copied when first read, as they may be modified in place.
+class Layered(MutableMapping):
+    __slots__ = ("_layers", "_delimiter", "_resolved", "_deleted", "_parent")
+
+    def __init__(self, *layers, delimiter=None, _parent=None):
+        object.__setattr__(self, "_layers", tuple(filter(None, layers)))
+        object.__setattr__(self, "_delimiter", delimiter)
+        object.__setattr__(self, "_resolved", dict())
+        object.__setattr__(self, "_deleted", set())
+        object.__setattr__(self, "_parent", _parent)
+
+    def _merge(self, values):
+        layers = []
+        value = None
+        for v in values:
+            if isinstance(v, Mapping):
+                layers = (layers if layers and (value is None) else []) + [v]
+                value = None
+                continue
+            if isinstance(v, list) and isinstance(value, list):
+                value = value + v
+            elif isinstance(v, set) and isinstance(value, set):
+                value = value | v
+            elif (
+                (self._delimiter is not None)
+                and isinstance(v, (str, bytes, bytearray))
+                and isinstance(value, type(v))
+            ):
+                value = value + self._delimiter + v
+            else:
+                value = v
+            layers = []
+        if layers:
+            return self.__class__(*layers, delimiter=self._delimiter)
+        return value
+
+    def _missing(self, key):
+        return self.__class__(delimiter=self._delimiter, _parent=(self, key))
+
+    def _attach(self):
+        if self._parent:
+            parent, key = self._parent
+            object.__setattr__(self, "_parent", None)
+            parent[key] = self
+
+    def __contains__(self, key):
+        return (key in self._resolved) or (
+            (key not in self._deleted) and any(key in layer for layer in self._layers)
+        )
+
+    def __getitem__(self, key):
+        if key in self._resolved:
+            return self._resolved[key]
+        if key not in self:
+            return self._missing(key)
+        value = self._merge(layer[key] for layer in self._layers if key in layer)
+        if isinstance(value, (list, set)):
+            value = value.copy()
+        if isinstance(value, (self.__class__, list, set, dict)):
+            self._resolved[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._resolved[key] = value
+        self._deleted.discard(key)
+        self._attach()
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._resolved.pop(key, None)
+        self._deleted.add(key)
+
+    def __iter__(self):
+        return iter(
+            k for k in dict.fromkeys(chain(*self._layers, self._resolved)) if k in self
+        )
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __getattr__(self, attr):
+        if attr.startswith("__") or (attr in self.__slots__):
+            raise AttributeError(attr)
+        return self[attr]
+
+    def __setattr__(self, attr, value):
+        self[attr] = value
+
+    def __delattr__(self, attr):
+        del self[attr]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def to_dict(self, factory=dict):
+        def inner(value):
+            if isinstance(value, Mapping):
+                return factory({k: inner(v) for k, v in value.items()})
+            return value
+
+        return inner(self)
+
+    def __or__(self, other):
+        return Dict(self.to_dict()) | other
+
+    def __ror__(self, other):
+        return Dict(other) | self.to_dict()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.to_dict()!r})"
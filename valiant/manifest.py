@@ -0,0 +1,138 @@
+import orjson as json
+import threading
+
+from addict import Dict
+from autoslot import Slots
+from os import environ
+
+from .miscellaneous import local, write_atomic
+from .path import SuperPath, xxh
+from .sh import SH
+
+
+# NOTE: Manifests live outside of the projects they describe,
+#       as projects are added to git wholesale after tangling.
+class Manifest(Slots):
+    def __init__(self, kind, key, directory=local, file=None):
+        self.file = (
+            SuperPath(file)
+            if file
+            else SuperPath(
+                directory, kind, xxh(str(key).encode()).hexdigest() + ".json"
+            )
+        )
+        try:
+            self.entries = json.loads(self.file.read_bytes())
+        except (OSError, ValueError):
+            self.entries = dict()
+        self.modified = False
+
+    def __contains__(self, key):
+        return str(key) in self.entries
+
+    def __getitem__(self, key):
+        return self.entries[str(key)]
+
+    def __setitem__(self, key, value):
+        self.entries[str(key)] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self.entries[str(key)]
+        self.modified = True
+
+    def get(self, key, default=None):
+        return self.entries.get(str(key), default)
+
+    def items(self):
+        return self.entries.items()
+
+    def clear(self):
+        self.entries.clear()
+        self.modified = True
+
+    def save(self):
+        if self.modified:
+            try:
+                write_atomic(self.file, json.dumps(self.entries))
+            except OSError:
+                pass
+            else:
+                self.modified = False
+
+
+flakeSources = dict()
+flakeSourcesLock = threading.Lock()
+
+
+# NOTE: Memoized for the lifetime of the process, as each lookup would spawn git otherwise;
+#       keyed on the stats of `flake.nix' and `flake.lock',
+#       so files tangled or updated in the meantime still change the source.
+def flakeSource(flake, sh=SH):
+    def stat(file):
+        try:
+            s = (flake / file).stat()
+            return s.st_size, s.st_mtime_ns
+        except OSError:
+            return None
+
+    key = (str(flake), id(sh), *map(stat, ("flake.nix", "flake.lock")))
+    with flakeSourcesLock:
+        if key in flakeSources:
+            return flakeSources[key]
+    source = readFlakeSource(flake, sh)
+    with flakeSourcesLock:
+        flakeSources[key] = source
+    return source
+
+
+# NOTE: Uncommitted changes to tracked files are part of the source,
+#       as the flake may import any of them.
+def readFlakeSource(flake, sh=SH):
+    try:
+        git = sh.git.bake("--no-pager", C=flake)
+        diff = git("diff", "HEAD", "--binary", "--no-color", "--", ".")
+        tree = str(git("rev-parse", "HEAD:./"))
+        if not diff:
+            return "tree:" + tree
+        return "diff:" + xxh(f"{tree}\0{diff}".encode()).hexdigest()
+    except Exception:
+        pass
+    return (
+        "content:"
+        + xxh(
+            b"\0".join(
+                (flake / file).read_bytes() if (flake / file).exists() else b""
+                for file in ("flake.nix", "flake.lock")
+            )
+        ).hexdigest()
+    )
+
+
+# NOTE: Flake outputs are keyed on the git tree of the flake directory and its uncommitted changes,
+#       or on the contents of `flake.nix' and `flake.lock' outside of git;
+#       entries from any other source are dropped when a new one is stored.
+class FlakeCache(Manifest):
+    def __init__(self, flake, sh=SH, directory=local):
+        super().__init__("flake", flake, directory=directory)
+        self.source = flakeSource(SuperPath(flake), sh)
+
+    @staticmethod
+    def key(**kwargs):
+        return xxh(
+            json.dumps(
+                kwargs | dict(nix_config=environ.get("NIX_CONFIG", "")),
+                option=json.OPT_SORT_KEYS,
+            )
+        ).hexdigest()
+
+    def lookup(self, **kwargs):
+        value = self.get(self.key(**kwargs))
+        if value and (value[0] == self.source):
+            return Dict(value[1])
+
+    def store(self, result, **kwargs):
+        for key in [k for k, v in self.items() if v[0] != self.source]:
+            del self[key]
+        self[self.key(**kwargs)] = [self.source, result]
+        self.save()
@@ -1,14 +1,16 @@
 import json
+import marshal
 import os
+import platform
 import sys
+import threading
 
 from addict import Dict
 from collections import namedtuple
 from contextlib import contextmanager
 from functools import partial
-from importlib.machinery import SourceFileLoader, SOURCE_SUFFIXES
 from importlib.resources import files
-from importlib.util import spec_from_file_location, module_from_spec
+from importlib.util import MAGIC_NUMBER
 from inspect import getfullargspec
 from itertools import chain
 from more_itertools import collapse
@@ -19,12 +21,12 @@ from rich.console import Console
 from rich.padding import Padding
 from rich.pretty import pprint, pretty_repr
 from rich.text import Text
-from shutil import which
+from shutil import copy, which
 from tempfile import TemporaryDirectory
 from types import ModuleType
 from typing import Iterable
 
-from .path import SuperPath
+from .path import SuperPath, xxh
 from .sh import *
 
 
@@ -165,38 +167,35 @@ def cprint(*args):
 chrooted = environ.get("NIX_ENFORCE_PURITY", 0)
 
 
-# Adapted From:
-# Answer: https://stackoverflow.com/a/51575963
-# User: https://stackoverflow.com/users/3147711/alex-walczak
-@contextmanager
-def source_suffixes(*args):
-    try:
-        SOURCE_SUFFIXES.extend(args)
-        yield
-    finally:
-        del SOURCE_SUFFIXES[-len(args) :]
-
-
-# Adapted From:
-# Answer: https://stackoverflow.com/a/19011259/10827766
-# User: https://stackoverflow.com/users/2225682/falsetru
-# And: https://www.geeksforgeeks.org/how-to-import-a-python-module-given-the-full-path/#:~:text=Inside%20explicit%20method-,Using%20importlib%20Package,-The%20importlib%20package
-def module_installed(path, *args):
+# NOTE: Option files are compiled in place, with their bytecode cached in `cache', if any,
+#       under the hash of their path, along with the hash of the source it came from;
+#       `*args' used to be extra source suffixes, and are only kept for compatibility.
+def module_installed(path, *args, cache=None):
     path = SuperPath(path, strict=True)
-    name = path.stem
-    with TemporaryDirectory() as tmpDirectory:
-        tmpDirectory = Path(tmpDirectory)
-        tmpFile = tmpDirectory / f"{name}.py"
-        path.copy(tmpFile)
-        with source_suffixes(*args):
-            if spec := spec_from_file_location(name, str(tmpFile)):
-                loader = spec.loader
-                module = module_from_spec(spec)
-            else:
-                loader = SourceFileLoader(name, str(tmpFile))
-                module = ModuleType(loader.name)
-            loader.exec_module(module)
-            return module
+    source = path.read_bytes()
+    module = ModuleType(path.stem)
+    module.__file__ = str(path)
+    exec(compiled(source, path, cache), module.__dict__)
+    return module
+
+
+def compiled(source, path, cache):
+    if not cache:
+        return compile(source, str(path), "exec", dont_inherit=True)
+    file = SuperPath(cache, xxh(str(path).encode()).hexdigest() + ".pyc")
+    header = MAGIC_NUMBER + xxh(source).digest()
+    try:
+        data = file.read_bytes()
+        if data.startswith(header):
+            return marshal.loads(data[len(header) :])
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    code = compile(source, str(path), "exec", dont_inherit=True)
+    try:
+        write_atomic(file, header + marshal.dumps(code))
+    except OSError:
+        pass
+    return code
 
 
 def conf_to_dict(config):
@@ -403,6 +402,73 @@ for binary in (
         localBin.symlink_to(binary)
 
 
+def write_atomic(file, data):
+    file = Path(file)
+    file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = file.with_name(f".{file.name}.{os.getpid()}.{threading.get_ident()}")
+    if isinstance(data, (bytes, bytearray)):
+        tmp.write_bytes(data)
+    else:
+        tmp.write_text(data)
+    if file.exists():
+        tmp.chmod(file.stat().st_mode)
+    tmp.replace(file)
+
+
+def platformSystem():
+    machine = platform.machine().lower()
+    return (
+        dict(amd64="x86_64", x64="x86_64", arm64="aarch64").get(machine, machine)
+        + "-"
+        + platform.system().lower()
+    )
+
+
+currentSystemCache = local / "currentSystem.json"
+
+
+# NOTE: The resolved nix binary is a store path containing the nix version,
+#       so it's used alongside its size and modification time as the cache key.
+def getCurrentSystem(
+    sh=SH,
+    nix=None,
+    cache=currentSystemCache,
+    retries=3,
+    timeout=10,
+):
+    nix = SuperPath(nix or which("nix"))
+    if not (nix and nix.exists()):
+        return platformSystem()
+    stat = nix.stat()
+    key = ":".join(map(str, (nix, stat.st_size, stat.st_mtime_ns, platform.machine())))
+    try:
+        cached = json.loads(cache.read_text())
+    except (OSError, ValueError):
+        cached = dict()
+    if system := cached.get(key):
+        return system
+    for _ in range(retries):
+        try:
+            system = sh.nix.eval(
+                impure=True,
+                raw=True,
+                expr="builtins.currentSystem",
+                _timeout=timeout,
+            )
+        except sh.TimeoutException:
+            break
+        except sh.ErrorReturnCode:
+            system = None
+        if system:
+            cached[key] = system
+            write_atomic(cache, json.dumps(cached))
+            return system
+        warn("Sorry! Couldn't get the current system; trying again...")
+    system = platformSystem()
+    warn(f"Couldn't get the current system from nix; using {system} instead.")
+    return system
+
+
 @contextmanager
 def environment(**kwargs):
     global environ
@@ -475,204 +541,342 @@ def setOpts(opts, directory, directory_defaults):
     return opts
 
 
+flakeRemovals = (
+    "app",
+    "apps",
+    "channels",
+    "defaultApp",
+    "defaultdevShell",
+    "defaultDevShell",
+    "defaultPackage",
+    "defaultTemplate",
+    "devShell",
+    "devShells",
+    "legacyPackages",
+    "lib",
+    "package",
+    "packages",
+    "pkgs",
+    "superpkgs",
+    "template",
+    "templates",
+)
+
+# NOTE: The flake outputs read by `collectDirs' and `Gauntlet';
+#       nested attributes are written as dotted paths.
+flakeAttrs = (
+    "doCheck",
+    "group",
+    "parallel",
+    "pname",
+    "testFiles",
+    "type",
+    "valiant",
+)
+
+
+# NOTE: `convert' is bound outside of the `lib' scope,
+#       and names from `builtins' are qualified in the expressions following this,
+#       as looking them up would go through the `with' of `lib' first;
+#       expressions that never use `removeNonJSON' or `select' then never fetch the `lib' flake.
+def nixPrelude(remove=tuple()):
+    remove = " ".join(f'"{r}"' for r in chain(remove, flakeRemovals))
+    return f"""
+
+        with builtins;
+        let
+            convert = v: if (isAttrs v) then (mapAttrs (n: convert) v)
+                    else if (isList v) then (map convert v)
+                    else if (isPath v) then (toString v)
+                    else v;
+            getFlake' = directory: ((builtins.getFlake or import) directory).outputs;
+        in
+        with ((builtins.getFlake or import) "{resources / "lib"}").lib;
+        let
+            removeNonJSON' = obj:
+                if ((isFunction obj) || (isDerivation obj)) then
+                    null
+                else if (isAttrs obj) then
+                    (mapAttrs (n: removeNonJSON') obj)
+                else if (isList obj) then
+                    (map removeNonJSON' obj)
+                else
+                    obj;
+            removeNonJSON = obj:
+                removeNonJSON' (removeAttrs obj (flatten [
+                    {remove}
+                    systems.doubles.all
+                    "outPath"
+                ]));
+            select = paths: flake: foldl' recursiveUpdate {{ }} (map
+                (path: setAttrByPath path (removeNonJSON' (attrByPath path null flake)))
+                paths);
+        in
+
+    """
+
+
+# NOTE: Only forces the attributes in `attrs', as `null' when missing,
+#       unless the `full' dump of the outputs is asked for.
+def flakeExpression(directory, attrs=flakeAttrs, full=False):
+    if full:
+        return f'removeNonJSON (getFlake\' "{directory}")'
+    paths = " ".join(
+        "[ " + " ".join(f'"{a}"' for a in attr.split(".")) + " ]" for attr in attrs
+    )
+    return f'select [ {paths} ] (getFlake\' "{directory}")'
+
+
+# NOTE: Results are cached on disk in `cache', unless it's `None';
+#       see `FlakeCache'.
 def getFlake(
     remove=tuple(),
     directory=Path.cwd(),
     ignore_error=False,
     sh=SH,
+    attrs=flakeAttrs,
+    full=False,
+    cache=local,
+    refresh=False,
 ):
-    remove = (
-        f'"{r}"'
-        for r in chain(
-            remove,
-            (
-                "app",
-                "apps",
-                "channels",
-                "defaultApp",
-                "defaultdevShell",
-                "defaultDevShell",
-                "defaultPackage",
-                "defaultTemplate",
-                "devShell",
-                "devShells",
-                "legacyPackages",
-                "lib",
-                "package",
-                "packages",
-                "pkgs",
-                "superpkgs",
-                "template",
-                "templates",
-            ),
-        )
-    )
     if (directory / "flake.nix").exists():
         getflake = sh.nix.eval.bake(
             expr=normalizeMultiline(
-                f"""
-
-                    with builtins;
-                    with ((builtins.getFlake or import) "{resources / "lib"}").lib;
-                    let
-                        flake = (builtins.getFlake or import) "{directory}";
-                        removeNonJSON' = obj:
-                            if ((isFunction obj) || (isDerivation obj)) then
-                                null
-                            else if (isAttrs obj) then
-                                (mapAttrs (n: removeNonJSON') obj)
-                            else if (isList obj) then
-                                (map removeNonJSON' obj)
-                            else
-                                obj;
-                        removeNonJSON = obj:
-                            removeNonJSON' (removeAttrs obj (flatten [
-                                {" ".join(remove)}
-                                systems.doubles.all
-                                "outPath"
-                            ]));
-                        in toJSON (removeNonJSON flake.outputs)
-
-                """
+                nixPrelude(remove)
+                + f"builtins.toJSON ({flakeExpression(directory, attrs=attrs, full=full)})"
             ),
             **chooseShKwargsOpts("nixEval", sh),
         )
+
+        def evaluate():
+            if not cache:
+                return Dict(json.loads(getflake()))
+            from .manifest import FlakeCache
+
+            flakeCache = FlakeCache(directory, sh=sh, directory=cache)
+            key = dict(remove=remove, attrs=attrs, full=full)
+            if refresh or ((result := flakeCache.lookup(**key)) is None):
+                result = Dict(json.loads(getflake()))
+                flakeCache.store(result, **key)
+            return result
+
         if ignore_error or chrooted:
             try:
-                return Dict(json.loads(getflake()))
+                return evaluate()
             except Exception:
                 return Dict()
         else:
-            return Dict(json.loads(getflake()))
+            return evaluate()
     else:
         return Dict()
 
 
-def collectDirs(
+# NOTE: Evaluates the flakes of all `directories' in a single `nix eval';
+#       flakes that fail to evaluate come back empty, as with `ignore_error',
+#       and if the batch as a whole fails, each flake is evaluated on its own.
+def getFlakes(
     directories,
-    all_formats=False,
-    dependencies=tuple(),
-    first_call=True,
-    formats=tuple(),
-    sh=SH,
     remove=tuple(),
-    skip_dependencies=False,
-    optsParser=None,
-    log=None,
+    sh=SH,
+    attrs=flakeAttrs,
+    full=False,
+    cache=local,
+    refresh=False,
 ):
-    paths = dict()
-    gf = partial(
-        getFlake,
-        sh=sh,
-        ignore_error=True,
-        remove=remove,
+    from .manifest import FlakeCache
+
+    flakes = {directory: Dict() for directory in directories}
+    key = dict(remove=remove, attrs=attrs, full=full)
+    pending = dict()
+    for directory in flakes:
+        if (directory / "flake.nix").exists():
+            flakeCache = (
+                FlakeCache(directory, sh=sh, directory=cache) if cache else None
+            )
+            if flakeCache and (not refresh) and (cached := flakeCache.lookup(**key)):
+                flakes[directory] = cached
+            else:
+                pending[directory] = flakeCache
+    if not pending:
+        return flakes
+    outputs = " ".join(
+        f'"{directory}" = {flakeExpression(directory, attrs=attrs, full=full)};'
+        for directory in pending
     )
-
-    def inner(d):
-        return setOpts(
-            optsParser(
-                all_formats=all_formats,
-                directory=d,
-                format=formats,
-                remove=remove,
+    try:
+        evaluated = json.loads(
+            sh.nix.eval(
+                expr=normalizeMultiline(
+                    nixPrelude(remove)
+                    + f"""
+
+                        builtins.toJSON (builtins.mapAttrs (n: v:
+                            let result = builtins.tryEval (builtins.deepSeq v v);
+                            in if result.success then result.value else null
+                        ) {{ {outputs} }})
+
+                    """
+                ),
+                **chooseShKwargsOpts("nixEval", sh),
             )
-            if optsParser
-            else Dict(),
-            d,
-            [],
         )
-
-    values = directories.values()
-    for directory, flake, opts in zip(
-        map(SuperPath, directories.keys()),
-        (v if v is None else v["flake"] for v in values),
-        (v if v is None else v["opts"] for v in values),
-    ):
-        if directory.exists():
-            flakeOpts = Dict(
-                flake=flake or gf(directory=directory),
-                opts=opts or inner(directory),
+    except Exception:
+        for directory in pending:
+            flakes[directory] = getFlake(
+                directory=directory,
+                sh=sh,
+                ignore_error=True,
+                remove=remove,
+                attrs=attrs,
+                full=full,
+                cache=cache,
+                refresh=refresh,
             )
-            if skip_dependencies:
-                paths[directory] = flakeOpts
+        return flakes
+    for directory, flakeCache in pending.items():
+        if (result := evaluated.get(str(directory))) is not None:
+            flakes[directory] = Dict(result)
+            if flakeCache:
+                flakeCache.store(result, **key)
+    return flakes
+
+
+def nonempty(file):
+    try:
+        return file.stat().st_size != 0
+    except OSError:
+        return False
+
+
+nixParts = ("opts", "vflake", "flake")
+
+
+# NOTE: Evaluates `<name>.nix', `<n>flake.nix' and `flake.nix' of a directory
+#       in a single `nix eval', as `{ opts = ...; vflake = ...; flake = ...; }';
+#       keys are only present for the files that exist, and among `parts'.
+#       A flake found in `FlakeCache' is left out of the expression,
+#       and nix isn't run at all when nothing is left to evaluate.
+def evaluateNix(
+    directory,
+    name="valiant",
+    remove=tuple(),
+    sh=SH,
+    attrs=flakeAttrs,
+    full=False,
+    cache=local,
+    refresh=False,
+    parts=nixParts,
+):
+    directory = Path(directory)
+    expressions = dict()
+    evaluated = Dict()
+    with TemporaryDirectory() as tmpDirectory:
+        if ("opts" in parts) and nonempty(file := directory / f"{name}.nix"):
+            expressions["opts"] = f"convert (import {file})"
+        if ("vflake" in parts) and nonempty(file := directory / f"{name[0]}flake.nix"):
+            tmpDirectory = Path(tmpDirectory)
+            copy(file, tmpDirectory / "flake.nix")
+            copy(resources / "default.nix", tmpDirectory / "default.nix")
+            expressions["vflake"] = flakeExpression(tmpDirectory, full=True)
+        if ("flake" in parts) and (directory / "flake.nix").exists():
+            if cache:
+                from .manifest import FlakeCache
+
+                flakeCache = FlakeCache(directory, sh=sh, directory=cache)
+                key = dict(remove=remove, attrs=attrs, full=full)
+            if cache and (not refresh) and (cached := flakeCache.lookup(**key)):
+                evaluated.flake = cached
             else:
-                try:
-                    same_dir = (
-                        SuperPath(
-                            sh.git.bake(C=directory)(
-                                "rev-parse",
-                                show_toplevel=True,
-                            )
-                        )
-                        == directory
-                    )
-                except SH.ErrorReturnCode:
-                    same_dir = False
-
-                if flakeOpts.opts:
-                    odirs = dict()
-                    for d in flakeOpts.opts.dirs:
-                        dd = SuperPath(directory, d)
-                        if dd not in chain(
-                            paths.keys(),
-                            directories.keys(),
-                        ):
-                            odirs[dd] = dict(flake=gf(directory=dd), opts=inner(dd))
-
-                    # IMPORTANT: This bit will add the current directory at the end,
-                    #            if it is a dependency listed in the `dirs' option.
-                    try:
-                        del odirs[directory]
-                        add_dir = True
-                    except KeyError:
-                        add_dir = same_dir and (not first_call)
-
-                    paths.update(
-                        collectDirs(
-                            odirs,
-                            all_formats=all_formats,
-                            dependencies=dependencies,
-                            first_call=False,
-                            formats=formats,
-                            sh=sh,
-                            remove=remove,
-                            skip_dependencies=skip_dependencies,
-                            optsParser=optsParser,
-                            log=log,
+                expressions["flake"] = flakeExpression(
+                    directory, attrs=attrs, full=full
+                )
+        if expressions:
+            evaluated.update(
+                Dict(
+                    json.loads(
+                        sh.nix.eval(
+                            expr=normalizeMultiline(
+                                nixPrelude(remove)
+                                + "builtins.toJSON { "
+                                + " ".join(
+                                    f"{k} = {v};" for k, v in expressions.items()
+                                )
+                                + " }"
+                            ),
+                            **chooseShKwargsOpts("nixEval", sh),
                         )
                     )
-                    if add_dir:
-                        paths[directory] = flakeOpts
-
-                elif same_dir or first_call:
-                    paths[directory] = flakeOpts
-
-                if (
-                    flakeOpts.flake.valiant
-                    or flakeOpts.opts.valiant
-                    or any(
-                        (directory / file).exists()
-                        for file in (
-                            "flake.org",
-                            "nix.org",
-                            ".valiant",
-                        )
-                    )
-                ):
-                    paths[directory] = flakeOpts
-
-                if dependencies:
-                    filtered_paths = collapse(
-                        chain((path,), path.parents)
-                        for path in paths.keys()
-                        if any(path.match(glob) for glob in dependencies)
-                    )
-                    paths = {k: v for k, v in paths.items() if k in filtered_paths}
+                )
+            )
+            if cache and ("flake" in expressions):
+                flakeCache.store(evaluated.flake, **key)
+        return evaluated
+
 
-                if log:
-                    for path in paths:
-                        log(f"Collected {path}...")
-    return paths
+nixEvaluations = dict()
+nixEvaluationsLock = threading.Lock()
+
+
+# NOTE: Memoizes `evaluateNix' for the lifetime of the process, part by part,
+#       keyed on the stats of the files involved, so `Opts' and `collectDirs'
+#       share a single evaluation per directory;
+#       only the `parts' not evaluated yet are evaluated, together.
+#       Returns `None' when the combined evaluation fails,
+#       in which case callers evaluate each file on its own,
+#       to keep their own error handling.
+def nixEvaluation(
+    directory,
+    name="valiant",
+    remove=tuple(),
+    sh=SH,
+    attrs=flakeAttrs,
+    full=False,
+    cache=local,
+    refresh=False,
+    parts=nixParts,
+):
+    directory = Path(directory)
+
+    def stat(file):
+        try:
+            s = (directory / file).stat()
+            return s.st_size, s.st_mtime_ns
+        except OSError:
+            return None
+
+    key = (
+        str(directory),
+        name,
+        tuple(remove),
+        tuple(attrs),
+        full,
+        str(cache),
+        id(sh),
+        *map(stat, (f"{name}.nix", f"{name[0]}flake.nix", "flake.nix", "flake.lock")),
+    )
+    with nixEvaluationsLock:
+        lock, evaluations = nixEvaluations.setdefault(key, (threading.Lock(), dict()))
+    with lock:
+        if missing := [part for part in parts if part not in evaluations]:
+            try:
+                evaluated = evaluateNix(
+                    directory,
+                    name=name,
+                    remove=remove,
+                    sh=sh,
+                    attrs=attrs,
+                    full=full,
+                    cache=cache,
+                    refresh=refresh,
+                    parts=missing,
+                )
+            except Exception:
+                evaluated = None
+            for part in missing:
+                evaluations[part] = None if evaluated is None else evaluated[part]
+        if any(evaluations[part] is None for part in parts):
+            return None
+        return Dict({part: evaluations[part] for part in parts})
 
 
 def write_random(file):
@@ -1,54 +1,96 @@
 import orjson as json
-import _jsonnet
-import dhall
-import rapidjson as hujson
-import pickle
-import xmltodict
-import yaml
+import os
 import tomllib
 
 from addict import Dict
 from autoslot import Slots
-from inspect import ismethod
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from inspect import isfunction, ismethod
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
 from .miscellaneous import (
     getFlake,
+    nixEvaluation,
     is_coll,
+    local,
     module_installed,
     chooseShKwargsOpts,
     normalizeMultiline,
     resources,
-    update,
 )
-from .path import SuperPath
+from .layered import Layered
+from .manifest import Manifest
+from .path import SuperPath, xxh
 from .sh import SH
 
+# NOTE: Bump this whenever a parser's output changes,
+#       so cached results from the previous parser aren't used.
+parserVersion = 1
+
+
+# NOTE: Computed once per class, as `dir' and `getattr' on every access add up;
+#       aliases like `py' are slots, and so aren't included.
+@cache
+def methodTable(cls):
+    return tuple(
+        m
+        for m in dir(cls)
+        if m not in cls.__slots__
+        and not m.startswith("_")
+        and isfunction(getattr(cls, m))
+    )
+
 
 class Opts(Slots):
+    _extensions = dict(bazel="bzl", nickel="ncl", python="py")
+    _parts = dict(flake="vflake", nix="opts")
+
+    # NOTE: Formats evaluated by external processes; see `_evaluate'.
+    _processes = ("cue", "flake", "nickel", "nix")
+
     def __init__(
         self,
         name,
         sh=SH,
+        refresh=False,
+        cache=local,
+        jobs=None,
     ):
         self._name = name
         self._sh = sh
+        self._refresh = refresh
+        self._cache = cache
+        self._jobs = jobs
         self.starlark = self.bazel
         self.bzl = self.bazel
         self.py = self.python
         self.vflake = self.flake
         self.ncl = self.nickel
+        self._files = {self._filename(m): m for m in self._methods}
 
     @property
     def _methods(self):
-        return [
-            m
-            for m in dir(self)
-            if m not in self.__slots__
-            and not m.startswith("_")
-            and ismethod(getattr(self, m))
-        ]
+        return methodTable(type(self))
+
+    def _filename(self, method):
+        if method == "flake":
+            return f"{self._name[0]}flake.nix"
+        return f"{self._name}.{self._extensions.get(method, method)}"
+
+    # NOTE: A single directory listing decides which formats are present,
+    #       instead of every format checking for its own file.
+    def _present(self, directory):
+        try:
+            with os.scandir(directory) as entries:
+                return {
+                    self._files[entry.name]
+                    for entry in entries
+                    if (entry.name in self._files) and not entry.is_dir()
+                }
+        except OSError:
+            return set()
 
     @property
     def _all_methods(self):
@@ -56,6 +98,48 @@ class Opts(Slots):
             m for m in dir(self) if not m.startswith("_") and ismethod(getattr(self, m))
         ]
 
+    # NOTE: Formats backed by whole external processes cache their results,
+    #       keyed by the file's identity and contents, and the parser arguments.
+    def _cached(self, format, file, parse, **key):
+        stat = file.stat()
+        identity = [stat.st_size, stat.st_mtime_ns, xxh(file.read_bytes()).hexdigest()]
+        manifest = Manifest("opts", file, self._cache)
+        entry = xxh(json.dumps([format, parserVersion, key], default=str)).hexdigest()
+        if (
+            (not self._refresh)
+            and (cached := manifest.get(entry))
+            and (cached[:3] == identity)
+        ):
+            return cached[3]
+        result = parse()
+        manifest[entry] = [*identity, result]
+        manifest.save()
+        return result
+
+    # NOTE: Formats backed by external processes run concurrently,
+    #       while the rest are evaluated here in the meantime;
+    #       results are still returned in the order of `formats'.
+    def _evaluate(self, formats, *args, **kwargs):
+        formats = list(formats)
+        background = [f for f in formats if f in self._processes]
+        if (len(background) < 2) or (self._jobs == 1):
+            return [getattr(self, f)(*args, **kwargs) for f in formats]
+        with ThreadPoolExecutor(self._jobs or len(background)) as executor:
+            futures = {
+                f: executor.submit(getattr(self, f), *args, **kwargs)
+                for f in background
+            }
+
+            # NOTE: In-process formats are parsed while the background ones run,
+            #       and only then are the futures collected.
+            results = {
+                f: getattr(self, f)(*args, **kwargs)
+                for f in formats
+                if f not in futures
+            }
+            results.update((f, future.result()) for f, future in futures.items())
+            return [results[f] for f in formats]
+
     def pickle(self, file=None, directory=Path.cwd(), *args, remove=tuple(), **kwargs):
         file = file or directory / f"{self._name}.pickle"
 
@@ -63,11 +147,29 @@ class Opts(Slots):
         # Answer: https://stackoverflow.com/a/55949699/10827766
         # User: https://stackoverflow.com/users/5422525/m-t
         if file.exists() and (file.stat().st_size != 0):
+            import pickle
+
             with file.open("rb") as handle:
                 return pickle.load(handle)
         else:
             return dict()
 
+    # NOTE: The default files are read from the combined evaluation of the directory,
+    #       shared with `collectDirs'; see `nixEvaluation'.
+    def _combined(self, method, file, directory, remove):
+        if file == directory / self._filename(method):
+            evaluated = nixEvaluation(
+                directory,
+                name=self._name,
+                remove=remove,
+                sh=self._sh,
+                cache=self._cache,
+                refresh=self._refresh,
+                parts=tuple(self._parts.values()),
+            )
+            if evaluated is not None:
+                return evaluated[self._parts[method]]
+
     def nix(self, file=None, directory=Path.cwd(), *args, remove=tuple(), **kwargs):
         file = file or directory / f"{self._name}.nix"
 
@@ -75,23 +177,31 @@ class Opts(Slots):
         # Answer: https://stackoverflow.com/a/55949699/10827766
         # User: https://stackoverflow.com/users/5422525/m-t
         if file.exists() and (file.stat().st_size != 0):
-            return json.loads(
-                self._sh.nix.eval(
-                    expr=normalizeMultiline(
-                        f"""
-
-                            with builtins; let
-                                convert = v: if (isAttrs v) then (mapAttrs (n: convert) v)
-                                        else if (isList v) then (map convert v)
-                                        else if (isPath v) then (toString v)
-                                        else v;
-                            in toJSON (convert (import {file}))
-
-                        """
-                    ),
-                    **chooseShKwargsOpts("nixEval", self._sh),
+
+            def parse():
+                if (
+                    combined := self._combined("nix", file, directory, remove)
+                ) is not None:
+                    return combined
+                return json.loads(
+                    self._sh.nix.eval(
+                        expr=normalizeMultiline(
+                            f"""
+
+                                with builtins; let
+                                    convert = v: if (isAttrs v) then (mapAttrs (n: convert) v)
+                                            else if (isList v) then (map convert v)
+                                            else if (isPath v) then (toString v)
+                                            else v;
+                                in toJSON (convert (import {file}))
+
+                            """
+                        ),
+                        **chooseShKwargsOpts("nixEval", self._sh),
+                    )
                 )
-            )
+
+            return self._cached("nix", file, parse)
         else:
             return dict()
 
@@ -106,11 +216,25 @@ class Opts(Slots):
         # Answer: https://stackoverflow.com/a/55949699/10827766
         # User: https://stackoverflow.com/users/5422525/m-t
         if file.exists() and (file.stat().st_size != 0):
-            with TemporaryDirectory() as tmpDirectory:
-                tmpDirectory = Path(tmpDirectory)
-                file.copy(tmpDirectory / "flake.nix")
-                (resources / "default.nix").copy(tmpDirectory / "default.nix")
-                return getFlake(directory=tmpDirectory, remove=remove, sh=self._sh)
+
+            def parse():
+                if (
+                    combined := self._combined("flake", file, directory, remove)
+                ) is not None:
+                    return combined
+                with TemporaryDirectory() as tmpDirectory:
+                    tmpDirectory = Path(tmpDirectory)
+                    file.copy(tmpDirectory / "flake.nix")
+                    (resources / "default.nix").copy(tmpDirectory / "default.nix")
+                    return getFlake(
+                        directory=tmpDirectory,
+                        remove=remove,
+                        sh=self._sh,
+                        full=True,
+                        cache=None,
+                    )
+
+            return self._cached("flake", file, parse, remove=remove)
         else:
             return dict()
 
@@ -124,7 +248,11 @@ class Opts(Slots):
             # Adapted From:
             # Answer: https://unix.stackexchange.com/a/700680/270053
             # User: https://unix.stackexchange.com/users/72364/timofey-drozhzhin
-            return tomllib.loads(self._sh.nickel.export(format="toml", file=file))
+            return self._cached(
+                "nickel",
+                file,
+                lambda: tomllib.loads(self._sh.nickel.export(format="toml", file=file)),
+            )
 
         else:
             return dict()
@@ -147,6 +275,8 @@ class Opts(Slots):
         # Answer: https://stackoverflow.com/a/55949699/10827766
         # User: https://stackoverflow.com/users/5422525/m-t
         if file.exists() and (file.stat().st_size != 0):
+            import rapidjson as hujson
+
             with file.open("rb") as f:
                 return hujson.load(
                     f,
@@ -177,6 +307,7 @@ class Opts(Slots):
         # Answer: https://stackoverflow.com/a/55949699/10827766
         # User: https://stackoverflow.com/users/5422525/m-t
         if file.exists() and (file.stat().st_size != 0):
+            import xmltodict
 
             def inner(value):
                 if isinstance(value, dict):
@@ -202,6 +333,8 @@ class Opts(Slots):
         # Answer: https://stackoverflow.com/a/55949699/10827766
         # User: https://stackoverflow.com/users/5422525/m-t
         if file.exists() and (file.stat().st_size != 0):
+            import _jsonnet
+
             return json.loads(
                 _jsonnet.evaluate_snippet("valiant", file.read_text(), ext_vars=kwargs)
             )
@@ -215,7 +348,9 @@ class Opts(Slots):
         # Answer: https://stackoverflow.com/a/55949699/10827766
         # User: https://stackoverflow.com/users/5422525/m-t
         if file.exists() and (file.stat().st_size != 0):
-            return json.loads(self._sh.cue.export(file))
+            return self._cached(
+                "cue", file, lambda: json.loads(self._sh.cue.export(file))
+            )
         else:
             return dict()
 
@@ -226,6 +361,8 @@ class Opts(Slots):
         # Answer: https://stackoverflow.com/a/55949699/10827766
         # User: https://stackoverflow.com/users/5422525/m-t
         if file.exists() and (file.stat().st_size != 0):
+            import dhall
+
             return dhall.loads(file.read_text())
         else:
             return dict()
@@ -239,7 +376,9 @@ class Opts(Slots):
         # Answer: https://stackoverflow.com/a/55949699/10827766
         # User: https://stackoverflow.com/users/5422525/m-t
         if file.exists() and (file.stat().st_size != 0):
-            module = module_installed(file, ext)
+            module = module_installed(
+                file, ext, cache=self._cache and SuperPath(self._cache, "bytecode")
+            )
             return {
                 attr: getattr(module, attr)
                 for attr in dir(module)
@@ -263,6 +402,8 @@ class Opts(Slots):
         # Answer: https://stackoverflow.com/a/55949699/10827766
         # User: https://stackoverflow.com/users/5422525/m-t
         if file.exists() and (file.stat().st_size != 0):
+            import yaml
+
             return yaml.safe_load(file.read_text())
         else:
             return dict()
@@ -297,30 +438,29 @@ class Opts(Slots):
             )
         else:
             if directory:
-                optsDict = dict()
                 if format and is_coll(format):
-                    for f in format:
-                        optsDict = update(
-                            optsDict,
+                    return Layered(
+                        *(
                             getattr(self, f)(
                                 directory=directory, *args, remove=remove, **kwargs
-                            ),
+                            )
+                            for f in format
                         )
-                    else:
-                        return Dict(optsDict)
+                    ).to_dict(Dict)
                 else:
+                    present = self._present(directory)
                     if all_formats:
-                        for format in self._methods:
-                            optsDict = update(
-                                optsDict,
-                                getattr(self, format)(
-                                    directory=directory, *args, remove=remove, **kwargs
-                                ),
+                        return Layered(
+                            *self._evaluate(
+                                filter(present.__contains__, self._methods),
+                                *args,
+                                directory=directory,
+                                remove=remove,
+                                **kwargs,
                             )
-                        else:
-                            return Dict(optsDict)
+                        ).to_dict(Dict)
                     else:
-                        for format in self._methods:
+                        for format in filter(present.__contains__, self._methods):
                             opts = getattr(self, format)(
                                 file=file,
                                 directory=directory,
@@ -331,6 +471,6 @@ class Opts(Slots):
                             if opts:
                                 return Dict(opts)
                         else:
-                            return Dict(optsDict)
+                            return Dict()
             else:
                 return Dict()
@@ -0,0 +1,70 @@
+import re
+
+from .path import SuperPath
+
+tangleArg = re.compile(r""":tangle\s+("[^"]*"|\S+)""", re.IGNORECASE)
+
+
+# NOTE: Returns `None' when a target can't be known without emacs,
+#       such as `:tangle yes' or an elisp expression.
+def tangleTargets(file):
+    file = SuperPath(file)
+    targets = set()
+    for line in file.read_text().split("\n"):
+        if (
+            line.strip()
+            .lower()
+            .startswith(("#+begin_src", "#+property:", ":header-args"))
+        ):
+            for target in tangleArg.findall(line):
+                target = target.strip('"')
+                if target == "no":
+                    continue
+                if (target == "yes") or target.startswith("("):
+                    return None
+                targets.add(SuperPath(file.parent, target))
+    return targets
+
+
+inputArg = re.compile(
+    r"""^\s*#\+(?:include|setupfile):\s*("[^"]*"|\S+)""", re.IGNORECASE
+)
+
+
+# NOTE: Recursively collects the files pulled in through `#+INCLUDE' and `#+SETUPFILE';
+#       remote setup files are ignored.
+def orgInputs(file, seen=None):
+    file = SuperPath(file)
+    seen = set() if seen is None else seen
+    for line in file.read_text().split("\n"):
+        if match := inputArg.match(line):
+            target = match.group(1).strip('"').split("::")[0]
+            if "://" in target:
+                continue
+            target = SuperPath(file.parent, target)
+            if target not in seen:
+                seen.add(target)
+                if (target.suffix == ".org") and target.is_file():
+                    orgInputs(target, seen)
+    return seen
+
+
+exportArg = re.compile(r"""^\s*#\+export_file_name:\s*("[^"]*"|\S+)""", re.IGNORECASE)
+
+
+# NOTE: Only the files named through `#+EXPORT_FILE_NAME' can be known without emacs;
+#       names without an extension match any extension, as it depends on the backend.
+def exportTargets(file):
+    file = SuperPath(file)
+    return {
+        SuperPath(file.parent, match.group(1).strip('"'))
+        for match in map(exportArg.match, file.read_text().split("\n"))
+        if match
+    }
+
+
+def exported(target):
+    target = SuperPath(target)
+    if target.suffix:
+        return target.is_file()
+    return any(target.parent.glob(target.name + ".*"))
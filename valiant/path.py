@@ -10,6 +10,8 @@ from os.path import expandvars
 from pathlib import Path
 from typing import Self
 
+xxh = getattr(xxhash, "xxh" + platform.architecture()[0][:2])
+
 
 class BasePath(type(Path())):
     def __new__(cls, *args, **kwargs):
@@ -71,8 +73,11 @@ class BasePath(type(Path())):
     def _hashcmp(self, other):
         with self.open("rb") as a:
             with open(other, "rb") as b:
-                xx = getattr(xxhash, "xxh" + platform.architecture()[0][:2])
-                return xx(a.read()).hexdigest() == xx(b.read()).hexdigest()
+                return xxh(a.read()).hexdigest() == xxh(b.read()).hexdigest()
+
+    def xxhexdigest(self):
+        with self.open("rb") as f:
+            return xxh(f.read()).hexdigest()
 
     def hashcmp(self, other):
         if self.is_dir():
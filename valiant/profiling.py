@@ -0,0 +1,177 @@
+import orjson as json
+import os
+import shlex
+import threading
+import time
+
+from addict import Dict
+from autoslot import Slots
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+
+# NOTE: Spans are only recorded between `start' and `stop',
+#       so unprofiled runs pay for a single attribute check.
+class Profiler(Slots):
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = 0
+        self.cpu = 0
+
+    def start(self):
+        self.events.clear()
+        self.origin = time.perf_counter_ns()
+        self.cpu = time.process_time_ns()
+        self.enabled = True
+
+    def now(self):
+        return (time.perf_counter_ns() - self.origin) / 1000
+
+    def record(self, kind, name, start, wall, cpu=None, **args):
+        thread = threading.current_thread()
+        event = Dict(
+            kind=kind,
+            name=name,
+            start=start,
+            wall=wall,
+            cpu=cpu,
+            thread=thread.ident,
+            threadName=thread.name,
+            args=args,
+        )
+        with self.lock:
+            self.events.append(event)
+        return event
+
+    @contextmanager
+    def _span(self, name, kind, args):
+        start = self.now()
+        cpu = time.thread_time_ns()
+        try:
+            yield
+        finally:
+            self.record(
+                kind,
+                name,
+                start,
+                self.now() - start,
+                (time.thread_time_ns() - cpu) / 1000,
+                **args,
+            )
+
+    def span(self, name, kind="phase", **args):
+        return self._span(name, kind, args) if self.enabled else nullcontext()
+
+    # NOTE: `command' is a fully baked `sh' command;
+    #       see `SH.__call__'.
+    def subprocess(self, command):
+        if not self.enabled:
+            return command()
+        argv = shlex.split(str(command))
+        exit_code = None
+
+        def done(cmd, success, code):
+            nonlocal exit_code
+            exit_code = code
+
+        start = self.now()
+        try:
+            # NOTE: `_done' can't be combined with `_fg'.
+            if command._partial_call_args.get("fg"):
+                return command()
+            return command(_done=done)
+        except Exception as e:
+            exit_code = getattr(e, "exit_code", exit_code)
+            raise
+        finally:
+            self.record(
+                "subprocess",
+                Path(argv[0]).name if argv else "",
+                start,
+                self.now() - start,
+                argv=argv,
+                exit_code=exit_code,
+            )
+
+    def summary(self):
+        times = os.times()
+        summary = Dict(
+            units="microseconds",
+            wall=self.now(),
+            cpu=(time.process_time_ns() - self.cpu) / 1000,
+            children_cpu=(times.children_user + times.children_system) * 1e6,
+        )
+        for event in self.events:
+            if event.kind == "subprocess":
+                continue
+            totals = [summary[event.kind + "s"][event.name]]
+            if project := event.args.project:
+                totals.append(summary.projects[project][event.kind + "s"][event.name])
+            for total in totals:
+                total.count = (total.count or 0) + 1
+                total.wall = (total.wall or 0) + event.wall
+                total.cpu = (total.cpu or 0) + event.cpu
+        summary.subprocesses = [
+            dict(
+                argv=event.args.argv,
+                start=event.start,
+                duration=event.wall,
+                exit_code=event.args.exit_code,
+            )
+            for event in self.events
+            if event.kind == "subprocess"
+        ]
+        return summary
+
+    # NOTE: Uses complete events from the Trace Event Format:
+    #       https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+    def trace(self):
+        pid = os.getpid()
+        events = [
+            dict(
+                name=event.name,
+                cat=event.kind,
+                ph="X",
+                ts=event.start,
+                dur=event.wall,
+                pid=pid,
+                tid=event.thread,
+                args=event.args
+                | (dict() if event.cpu is None else dict(cpu=event.cpu)),
+            )
+            for event in self.events
+        ]
+        threads = {event.thread: event.threadName for event in self.events}
+        events.extend(
+            dict(name="thread_name", ph="M", pid=pid, tid=tid, args=dict(name=name))
+            for tid, name in threads.items()
+        )
+        return dict(traceEvents=events, displayTimeUnit="ms")
+
+    # NOTE: Writes `<prefix>.json' with the summary,
+    #       and `<prefix>.trace.json' for `chrome://tracing' or Perfetto.
+    def stop(self, prefix):
+        self.enabled = False
+        prefix = Path(prefix)
+        files = (
+            prefix.with_name(prefix.name + ".json"),
+            prefix.with_name(prefix.name + ".trace.json"),
+        )
+        for file, data in zip(files, (self.summary(), self.trace())):
+            file.write_bytes(json.dumps(data, default=str, option=json.OPT_INDENT_2))
+        return files
+
+    @contextmanager
+    def session(self, prefix, log=None):
+        self.start()
+        try:
+            yield self
+        finally:
+            files = self.stop(prefix)
+            if log:
+                log("Profile written to", *map(str, files))
+
+
+profiler = Profiler()
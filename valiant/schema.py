@@ -0,0 +1,146 @@
+from addict import Dict
+from collections.abc import Mapping
+
+from .layered import Layered
+
+
+def toDict(value):
+    if isinstance(value, Layered):
+        return value.to_dict(Dict)
+    elif isinstance(value, Mapping) and not isinstance(value, Dict):
+        return Dict(value)
+    return value
+
+
+# NOTE: Options read on hot paths are compiled into slotted objects with defaults,
+#       so reading an unset option no longer allocates empty `Dict's;
+#       keys outside of the schema are still readable as attributes, through `_extra'.
+class Options:
+    __slots__ = ("_extra",)
+    _fields = dict()
+
+    def __init__(self, options=None):
+        options = dict() if options is None else options
+        object.__setattr__(self, "_extra", Dict())
+        for k, v in options.items():
+            self[k] = v
+        for k, default in self._fields.items():
+            if k not in options:
+                object.__setattr__(
+                    self, k, default() if isinstance(default, type) else default
+                )
+
+    @staticmethod
+    def _convert(value, default):
+        if isinstance(default, type) and issubclass(default, Options):
+            return default(value if isinstance(value, Mapping) else None)
+        return toDict(value)
+
+    def __getattr__(self, attr):
+        if attr.startswith("__") or (attr == "_extra"):
+            raise AttributeError(attr)
+        return self._extra[attr]
+
+    def __setattr__(self, attr, value):
+        if attr in self._fields:
+            object.__setattr__(self, attr, self._convert(value, self._fields[attr]))
+        else:
+            self._extra[attr] = toDict(value)
+
+    def __delattr__(self, attr):
+        if attr in self._fields:
+            default = self._fields[attr]
+            object.__setattr__(
+                self, attr, default() if isinstance(default, type) else default
+            )
+        else:
+            del self._extra[attr]
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        delattr(self, key)
+
+    def __contains__(self, key):
+        return (key in self._fields) or (key in self._extra)
+
+    def keys(self):
+        return [*self._fields, *self._extra]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._fields) + len(self._extra)
+
+    def values(self):
+        return [self[k] for k in self]
+
+    def items(self):
+        return [(k, self[k]) for k in self]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __bool__(self):
+        return any(self.values())
+
+    def to_dict(self):
+        return {
+            k: v.to_dict() if isinstance(v, (Options, Dict)) else v
+            for k, v in self.items()
+        }
+
+    def __eq__(self, other):
+        if isinstance(other, (Options, Mapping)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.to_dict()!r})"
+
+
+def schema(name, **fields):
+    return type(
+        name,
+        (Options,),
+        dict(__slots__=tuple(fields), _fields=fields, __module__=__name__),
+    )
+
+
+NixConfigOptions = schema(
+    "NixConfigOptions", file=None, opts=Dict, replace=False, text=""
+)
+
+GauntletOptions = schema(
+    "GauntletOptions",
+    command_post=list,
+    command_pre=list,
+    deps=schema("DepsOptions", args=list, shell=None),
+    devShell=None,
+    dirs=list,
+    export=schema("ExportOptions", enable=True, export_files=list),
+    format=Dict,
+    global_post=list,
+    global_pre=list,
+    nix=schema("NixOptions", config=NixConfigOptions),
+    nix_test=schema("NixTestOptions", cmd=None, deps=Dict, env=Dict),
+    super=schema("SuperOptions", test=True),
+    tangle=schema("TangleOptions", enable=True, tangle_files=list),
+    test=schema(
+        "TestOptions",
+        args=list,
+        cmd=None,
+        deps=Dict,
+        dirs=list,
+        enable=True,
+        env=Dict,
+        program=None,
+    ),
+    update=schema("UpdateOptions", enable=True, ignore=list),
+    verbose=0,
+)
@@ -8,6 +8,8 @@ from pathlib import Path
 from rich import print
 from rich.pretty import pprint
 
+from .profiling import profiler
+
 
 def filter_options(**options):
     return {
@@ -360,5 +362,5 @@ class SH(metaclass=SHMeta):
     ):
         _verbose = kwargs.pop("_verbose", None)
         self._print(p := self._build(*args, **kwargs), _verbose=_verbose, **kwargs)
-        if output := p():
+        if output := profiler.subprocess(p):
             return output.strip()
@@ -0,0 +1,488 @@
+import orjson as json
+import os
+import re
+
+from addict import Dict
+from autoslot import Slots
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from os import environ
+from pathlib import Path, PurePosixPath
+
+from .manifest import Manifest
+from .miscellaneous import (
+    getFlake,
+    getFlakes,
+    local,
+    nixEvaluation,
+    nixParts,
+    setOpts,
+)
+from .path import SuperPath, xxh
+from .sh import SH
+
+
+gitEnvironment = (
+    "GIT_CEILING_DIRECTORIES",
+    "GIT_DIR",
+    "GIT_DISCOVERY_ACROSS_FILESYSTEM",
+    "GIT_WORK_TREE",
+)
+gitToplevels = dict()
+
+
+# NOTE: Follows git's own discovery: walks up from `directory' to the first `.git'
+#       directory or `gitdir:' file, stopping at `GIT_CEILING_DIRECTORIES'
+#       and filesystem boundaries. Every directory on the way is memoized,
+#       so siblings only walk up to their closest common parent.
+#       Returns `...' for layouts left to `git' itself,
+#       such as `GIT_DIR' without `GIT_WORK_TREE', or directories inside a git directory.
+def findToplevel(directory, memo):
+    if environ.get("GIT_DIR"):
+        if worktree := environ.get("GIT_WORK_TREE"):
+            return Path(worktree).resolve()
+        return ...
+    if ".git" in directory.parts:
+        return ...
+    ceilings = {
+        Path(c).resolve()
+        for c in environ.get("GIT_CEILING_DIRECTORIES", "").split(os.pathsep)
+        if c
+    }
+    acrossFilesystems = environ.get("GIT_DISCOVERY_ACROSS_FILESYSTEM", "").lower() in (
+        "1",
+        "true",
+        "yes",
+        "on",
+    )
+    device = directory.stat().st_dev
+    visited = []
+    toplevel = None
+    for path in chain((directory,), directory.parents):
+        if visited and (
+            (path in ceilings)
+            or ((not acrossFilesystems) and (path.stat().st_dev != device))
+        ):
+            break
+        if path in memo:
+            toplevel = memo[path]
+            break
+        visited.append(path)
+        dotgit = path / ".git"
+        if dotgit.is_dir():
+            if (dotgit / "HEAD").is_file():
+                toplevel = path
+                break
+            return ...
+        if dotgit.is_file():
+            gitdir = dotgit.read_text().strip()
+            if gitdir.startswith("gitdir:") and (path / gitdir[7:].strip()).is_dir():
+                toplevel = path
+                break
+            return ...
+        if all((path / d).exists() for d in ("HEAD", "objects", "refs")):
+            return ...
+    for path in visited:
+        memo[path] = toplevel
+    return toplevel
+
+
+def gitToplevel(directory, sh=SH):
+    directory = Path(directory).resolve()
+    memo = gitToplevels.setdefault(tuple(map(environ.get, gitEnvironment)), dict())
+    if directory not in memo:
+        try:
+            toplevel = findToplevel(directory, memo)
+        except OSError:
+            toplevel = ...
+        if toplevel is ...:
+            try:
+                toplevel = Path(
+                    sh.git.bake(C=directory)("rev-parse", show_toplevel=True)
+                )
+            except SH.ErrorReturnCode:
+                toplevel = None
+        memo[directory] = toplevel
+    return memo[directory] and SuperPath(memo[directory])
+
+
+def globComponent(component):
+    pattern = []
+    i = 0
+    while i < len(component):
+        c = component[i]
+        i += 1
+        if c == "*":
+            pattern.append("[^/]*")
+        elif c == "?":
+            pattern.append("[^/]")
+        elif c == "[":
+            j = i + (component[i : i + 1] == "!")
+            j = component.find("]", j + (component[j : j + 1] == "]"))
+            if j == -1:
+                pattern.append(re.escape(c))
+            else:
+                chars = component[i:j].replace("\\", "\\\\")
+                i = j + 1
+                if chars.startswith("!"):
+                    chars = "^/" + chars[1:]
+                elif chars.startswith("^"):
+                    chars = "\\" + chars
+                pattern.append(f"[{chars}]")
+        else:
+            pattern.append(re.escape(c))
+    return "".join(pattern)
+
+
+# NOTE: Compiles globs into a single regular expression over whole paths,
+#       with the semantics of `PurePath.match': relative globs match from the right,
+#       while absolute ones have to match the whole path.
+def compileGlobs(globs):
+    patterns = []
+    for glob in globs:
+        parts = PurePosixPath(glob).parts
+        if parts and (parts[0] == "/"):
+            patterns.append("^/" + "/".join(map(globComponent, parts[1:])) + "$")
+        elif parts:
+            patterns.append("(?:^|/)" + "/".join(map(globComponent, parts)) + "$")
+    return re.compile("|".join(patterns)) if patterns else None
+
+
+# NOTE: Directories are discovered breadth-first from all of the roots at once,
+#       so each one's flake and options are only loaded once;
+#       edges that would close a cycle are dropped, leaving a DAG in `edges'.
+#       Loaded directories are recorded in `<cache>/.valiant-workspace.json',
+#       and reused on later runs for as long as their fingerprints match.
+class Workspace(Slots):
+    def __init__(
+        self,
+        roots,
+        all_formats=False,
+        dependencies=tuple(),
+        formats=tuple(),
+        sh=SH,
+        remove=tuple(),
+        skip_dependencies=False,
+        optsParser=None,
+        log=None,
+        refresh=False,
+        cache=local,
+        jobs=None,
+    ):
+        self.all_formats = all_formats
+        self.dependencies = compileGlobs(dependencies)
+        self.formats = formats
+        self.sh = sh
+        self.remove = remove
+        self.skip_dependencies = skip_dependencies
+        self.optsParser = optsParser
+        self.log = log
+        self.refresh = refresh
+        self.cache = cache
+        self.jobs = jobs
+        self.name = optsParser._name if optsParser else "valiant"
+        self.context = xxh(
+            json.dumps(
+                [
+                    self.name,
+                    all_formats,
+                    formats,
+                    remove,
+                    environ.get("NIX_CONFIG", ""),
+                ],
+                default=str,
+            )
+        ).hexdigest()
+        self.manifest = (
+            Manifest(
+                "workspace", None, file=SuperPath(cache, ".valiant-workspace.json")
+            )
+            if cache
+            else None
+        )
+
+        # NOTE: Roots may come with their flake and options already loaded,
+        #       as `{ directory: { "flake": ..., "opts": ... } }'.
+        if isinstance(roots, Mapping):
+            preloaded = {SuperPath(k): v for k, v in roots.items() if v}
+            roots = roots.keys()
+        else:
+            preloaded = dict()
+        self.roots = tuple(dict.fromkeys(map(SuperPath, roots)))
+
+        self.nodes = dict()
+        self.edges = dict()
+        self.order = []
+        self.cycles = []
+
+        # NOTE: Directories listing themselves in their `dirs' option,
+        #       which are collected after their dependencies.
+        self.selfListed = set()
+
+        self.discover(preloaded)
+        self.breakCycles()
+        if self.manifest is not None:
+            for directory in [d for d in self.manifest.entries if not os.path.isdir(d)]:
+                del self.manifest[directory]
+            self.manifest.save()
+
+    # NOTE: A single directory whose options are loaded next, in `unloaded',
+    #       shares an evaluation with them; otherwise only its flake is evaluated.
+    def getFlakes(self, directories, unloaded=tuple()):
+        if len(directories) == 1:
+            (directory,) = directories
+            if (
+                evaluated := nixEvaluation(
+                    directory,
+                    name=self.name,
+                    remove=self.remove,
+                    sh=self.sh,
+                    cache=self.cache,
+                    refresh=self.refresh,
+                    parts=nixParts if directory in unloaded else ("flake",),
+                )
+            ) is not None:
+                return {directory: evaluated.flake}
+            return {
+                directory: getFlake(
+                    directory=directory,
+                    sh=self.sh,
+                    ignore_error=True,
+                    remove=self.remove,
+                    cache=self.cache,
+                    refresh=self.refresh,
+                )
+            }
+        return getFlakes(
+            directories,
+            sh=self.sh,
+            remove=self.remove,
+            cache=self.cache,
+            refresh=self.refresh,
+        )
+
+    def getOpts(self, directory):
+        return setOpts(
+            self.optsParser(
+                all_formats=self.all_formats,
+                directory=directory,
+                format=self.formats,
+                remove=self.remove,
+            )
+            if self.optsParser
+            else Dict(),
+            directory,
+            [],
+        )
+
+    # NOTE: Covers the options, the nix files and lock file they may read,
+    #       and the directory itself, whose modification time changes when files are added or removed;
+    #       nix files outside of the directory are only picked up with `--refresh'.
+    #       Flakes aren't stored here, as `FlakeCache' already tracks their sources.
+    def fingerprint(self, directory):
+        files = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file() and (
+                        entry.name.startswith(self.name + ".")
+                        or entry.name.endswith(".nix")
+                        or (entry.name == "flake.lock")
+                    ):
+                        stat = entry.stat()
+                        files.append([entry.name, stat.st_size, stat.st_mtime_ns])
+            return [directory.stat().st_mtime_ns, *sorted(files)]
+        except OSError:
+            return None
+
+    def cached(self, directory, fingerprint):
+        if (self.manifest is None) or self.refresh or (fingerprint is None):
+            return None
+        entry = self.manifest.get(directory)
+        if (
+            entry
+            and (entry["context"] == self.context)
+            and (entry["fingerprint"] == fingerprint)
+        ):
+            return setOpts(Dict(entry["opts"]), directory, [])
+
+    def store(self, directory, fingerprint):
+        if (self.manifest is None) or (fingerprint is None):
+            return
+        node = self.nodes[directory]
+        entry = dict(
+            context=self.context,
+            fingerprint=fingerprint,
+            opts=node.opts | dict(dirs=list(map(str, node.opts.dirs or []))),
+        )
+        # NOTE: Options from formats such as `pickle' may not be JSON,
+        #       in which case the directory is loaded again on the next run.
+        try:
+            json.dumps(entry)
+        except TypeError:
+            return
+        self.manifest[directory] = entry
+
+    # NOTE: The flakes of a frontier are evaluated in one batch first,
+    #       so options read from a flake find it in `FlakeCache' instead of evaluating it again;
+    #       the options are then loaded in up to `jobs' threads,
+    #       and nodes are still added in the order of the frontier.
+    def load(self, frontier, preloaded):
+        fingerprints = {d: self.fingerprint(d) for d in frontier if d not in preloaded}
+        pending = {d: dict(preloaded.get(d) or dict()) for d in frontier}
+        for directory, fingerprint in fingerprints.items():
+            if (cached := self.cached(directory, fingerprint)) is not None:
+                pending[directory]["opts"] = cached
+        flakes = [d for d, value in pending.items() if not value.get("flake")]
+        opts = [d for d, value in pending.items() if not value.get("opts")]
+        flakes = self.getFlakes(flakes, opts)
+        if (self.jobs == 1) or (len(opts) < 2):
+            opts = {d: self.getOpts(d) for d in opts}
+        else:
+            with ThreadPoolExecutor(
+                self.jobs, thread_name_prefix="workspace"
+            ) as executor:
+                opts = dict(zip(opts, executor.map(self.getOpts, opts)))
+        for directory, value in pending.items():
+            self.nodes[directory] = Dict(
+                flake=value.get("flake") or flakes[directory],
+                opts=value.get("opts") or opts[directory],
+            )
+            if (directory in opts) and (directory in fingerprints):
+                self.store(directory, fingerprints[directory])
+        self.order.extend(frontier)
+
+    def discover(self, preloaded):
+        frontier = [root for root in self.roots if root.exists()]
+        seen = set(frontier)
+        while frontier:
+            self.load(frontier, preloaded)
+            following = []
+            for directory in frontier:
+                if self.skip_dependencies:
+                    self.edges[directory] = tuple()
+                    continue
+                dirs = tuple(
+                    dict.fromkeys(
+                        d
+                        for d in map(SuperPath, self.nodes[directory].opts.dirs or [])
+                        if d.exists()
+                    )
+                )
+                if directory in dirs:
+                    self.selfListed.add(directory)
+                self.edges[directory] = tuple(d for d in dirs if d != directory)
+                for d in self.edges[directory]:
+                    if d not in seen:
+                        seen.add(d)
+                        following.append(d)
+            frontier = following
+
+    def breakCycles(self):
+        finished = dict()
+
+        def visit(directory):
+            finished[directory] = False
+            edges = []
+            for d in self.edges[directory]:
+                if finished.get(d) is False:
+                    self.cycles.append((directory, d))
+                    continue
+                if d not in finished:
+                    visit(d)
+                edges.append(d)
+            self.edges[directory] = tuple(edges)
+            finished[directory] = True
+
+        for directory in self.order:
+            if directory not in finished:
+                visit(directory)
+
+    def isProject(self, directory):
+        node = self.nodes[directory]
+        return (
+            node.flake.valiant
+            or node.opts.valiant
+            or any(
+                (directory / file).exists()
+                for file in (
+                    "flake.org",
+                    "nix.org",
+                    ".valiant",
+                )
+            )
+        )
+
+    # NOTE: Returns the projects reachable from `roots', each after its dependencies;
+    #       a root is collected unless it has options and is not a project,
+    #       while a dependency is collected if it is a project or a repository root;
+    #       either is collected if it lists itself in its `dirs' option.
+    def collect(self, *roots):
+        roots = roots or self.roots
+        paths = dict()
+        visited = set()
+
+        def visit(directory):
+            visited.add(directory)
+            node = self.nodes[directory]
+            for d in self.edges[directory]:
+                if d not in visited:
+                    visit(d)
+            if (
+                self.skip_dependencies
+                or (directory in self.selfListed)
+                or self.isProject(directory)
+            ):
+                paths[directory] = node
+            else:
+                root = directory in roots
+                same_dir = gitToplevel(directory, sh=self.sh) == directory
+                if (same_dir and not root) if node.opts else (same_dir or root):
+                    paths[directory] = node
+
+        for root in roots:
+            if (root in self.nodes) and (root not in visited):
+                visit(root)
+
+        if self.dependencies:
+            matched = [path for path in paths if self.dependencies.search(str(path))]
+            filtered_paths = set(
+                chain(matched, chain.from_iterable(path.parents for path in matched))
+            )
+            paths = {k: v for k, v in paths.items() if k in filtered_paths}
+
+        if self.log:
+            for path in paths:
+                self.log(f"Collected {path}...")
+        return paths
+
+
+def collectDirs(
+    directories,
+    all_formats=False,
+    dependencies=tuple(),
+    formats=tuple(),
+    sh=SH,
+    remove=tuple(),
+    skip_dependencies=False,
+    optsParser=None,
+    log=None,
+    refresh=False,
+    cache=local,
+    jobs=None,
+):
+    return Workspace(
+        directories,
+        all_formats=all_formats,
+        dependencies=dependencies,
+        formats=formats,
+        sh=sh,
+        remove=remove,
+        skip_dependencies=skip_dependencies,
+        optsParser=optsParser,
+        log=log,
+        refresh=refresh,
+        cache=cache,
+        jobs=jobs,
+    ).collect()